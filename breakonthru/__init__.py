@@ -1,32 +1,44 @@
 import os
-import time
 
 from pyramid.config import Configurator
+from pyramid.events import NewResponse
 from pyramid.session import SignedCookieSessionFactory
-from pyramid.static import QueryStringConstantCacheBuster
 
+from breakonthru import assets
 from breakonthru.authentication import (
     SessionSecurityPolicy,
+    TokenVerifier,
     parse_passwords,
     parse_doors,
+    token_grace_secs,
 )
+from breakonthru.codec import get_codec
+from breakonthru.doorserverclient import DoorserverClient, LocalDoorserverClient
+from breakonthru.pages import IndexPages
+from breakonthru.throttle import PasswordChecker
 
 fiveyears = 5 * 365 * 24 * 60 * 60
 
 
-def main(global_config, **settings):
-    """This function returns a Pyramid WSGI application."""
+def main(global_config, doorserver=None, **settings):
+    """This function returns a Pyramid WSGI application.
+
+    ``lockit-server`` passes the Doorserver it runs in the same process as
+    ``doorserver``; the app then shares its passwords and token verifier and
+    sends it unlocks directly."""
     password_file = os.environ.get("DOORSERVER_PASSWORDS_FILE")
     if password_file is None:
         password_file = settings["password_file"]
     doors_file = os.environ.get("DOORSERVER_DOORS_FILE")
     if doors_file is None:
         doors_file = settings["doors_file"]
-    with open(password_file, "r") as f:
-        passwords_text = f.read()
     with open(doors_file, "r") as f:
         doors_text = f.read()
-    passwords = parse_passwords(passwords_text)
+    if doorserver is not None:
+        passwords = doorserver.passwords
+    else:
+        with open(password_file, "r") as f:
+            passwords = parse_passwords(f.read())
     with Configurator(settings=settings) as config:
         doorsip = os.environ.get("DOORSERVER_DOORSIP")
         if doorsip is None:
@@ -40,19 +52,75 @@ def main(global_config, **settings):
             wssecret = settings["secret"]
         config.registry.settings["secret"] = wssecret
         config.registry.settings["websocket_url"] = websocket_url
+        # directunlock talks to the doorserver over a pool of connections
+        # kept open by the webapp; doorserver_url lets it skip the public
+        # proxy when both run on the same host
+        if doorserver is not None:
+            client = LocalDoorserverClient(doorserver)
+        else:
+            doorserver_url = os.environ.get("DOORSERVER_URL")
+            if doorserver_url is None:
+                doorserver_url = settings.get("doorserver_url", websocket_url)
+            client = DoorserverClient(
+                doorserver_url,
+                wssecret,
+                get_codec(settings.get("websocket_codec", "json")),
+                int(settings.get("doorserver_connections", 2)),
+            )
+        config.registry.settings["doorserver_client"] = client
         config.registry.settings["passwords"] = passwords
-        config.registry.settings["doors"] = parse_doors(doors_text)
+        if doorserver is not None:
+            verifier = doorserver.token_verifier
+        else:
+            grace = os.environ.get("DOORSERVER_TOKEN_GRACE_SECS")
+            if grace is None:
+                grace = settings.get("token_grace_secs", token_grace_secs)
+            verifier = TokenVerifier(wssecret, passwords, grace_secs=int(grace))
+        config.registry.settings["token_verifier"] = verifier
+        doors = config.registry.settings["doors"] = parse_doors(doors_text)
+        pages = config.registry.settings["index_pages"] = IndexPages(
+            passwords, doors, websocket_url, doorsip
+        )
+        if doorserver is not None:
+            # a SIGHUP reloads the passwords for both
+            registry_settings = config.registry.settings
+
+            def reloaded(passwords):
+                registry_settings["passwords"] = passwords
+                pages.reload(passwords, doors)
+
+            doorserver.reload_hooks.append(reloaded)
+        config.registry.settings["password_checker"] = PasswordChecker(
+            workers=int(settings.get("login_workers", 1)),
+            queue_limit=int(settings.get("login_queue_limit", 2)),
+            failures_per_ip=int(settings.get("failed_logins_per_ip", 10)),
+            failures_per_user=int(settings.get("failed_logins_per_user", 5)),
+        )
         config.include("pyramid_chameleon")
-        config.add_static_view("static", "static", cache_max_age=3600)
-        config.add_static_view("js", "js", cache_max_age=0)
-        now = str(int(time.time()))
-        config.add_cache_buster("static", QueryStringConstantCacheBuster(now))
-        config.add_cache_buster("js", QueryStringConstantCacheBuster(now))
+        built = os.path.exists(assets.build_dir)
+        cachebuster = assets.ContentHashCacheBuster()
+        for name in assets.asset_dirs:
+            if built:
+                # serve the copies made by build-assets, which come with
+                # precompressed variants
+                config.override_asset(
+                    f"breakonthru:{name}/", f"breakonthru:build/{name}/"
+                )
+            config.add_static_view(
+                name,
+                name,
+                cache_max_age=assets.one_year,
+                content_encodings=["br", "gzip"] if built else [],
+            )
+            config.add_cache_buster(name, cachebuster)
+        config.add_subscriber(assets.immutable_assets, NewResponse)
         config.add_route("directunlock", "/directunlock")
         config.add_route("login", "/login")
         config.add_route("logout", "/logout")
         config.add_route("token", "/token")
         config.add_route("home", "/")
+        config.add_route("serviceworker", "/sw.js")
+        config.add_route("manifest", "/manifest.webmanifest")
         policy = SessionSecurityPolicy()
         config.set_security_policy(policy)
         factory = SignedCookieSessionFactory(
@@ -0,0 +1,106 @@
+"""Static asset serving.
+
+Asset URLs carry a hash of the asset's content (``?x=<hash>``), so they only
+change when the asset does; browsers are told to cache them for a year and
+never revalidate.  Running ``build-assets`` copies the assets into
+``breakonthru/build`` along with gzip (and, if the ``brotli`` package is
+installed, brotli) compressed variants; when that directory exists the app
+serves from it, picking a variant according to ``Accept-Encoding``."""
+
+import gzip
+import hashlib
+import os
+import shutil
+
+from pyramid.path import AssetResolver
+from pyramid.static import QueryStringCacheBuster
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+build_dir = os.path.join(here, "build")
+asset_dirs = ("static", "js")
+# only text compresses well enough to bother with; images are already packed
+compressible = (".css", ".js", ".html", ".json", ".svg", ".txt", ".webmanifest")
+one_year = 365 * 24 * 60 * 60
+
+
+class ContentHashCacheBuster(QueryStringCacheBuster):
+    """Adds a hash of the asset's content to its URL.  Assets are hashed the
+    first time a URL is generated for them and not again, as they don't
+    change while the app is running."""
+
+    def __init__(self, param="x"):
+        super().__init__(param)
+        self.resolver = AssetResolver()
+        self.tokens = {}
+
+    def tokenize(self, request, subpath, kw):
+        pathspec = kw["pathspec"]
+        token = self.tokens.get(pathspec)
+        if token is None:
+            with self.resolver.resolve(pathspec).stream() as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            token = self.tokens[pathspec] = digest[:16]
+        return token
+
+
+def immutable_assets(event):
+    """Mark cache-busted asset responses as immutable, so browsers don't
+    revalidate them even on reload; make browsers revalidate the rest"""
+    request = event.request
+    route = request.matched_route
+    if route is None or not route.name.startswith("__"):
+        return
+    response = event.response
+    if "x" not in request.GET:
+        # a URL without the hash could be anything next week
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    elif response.status_code == 200:
+        response.cache_control.public = True
+        cache_control = response.headers.get("Cache-Control")
+        if cache_control is not None:
+            response.headers["Cache-Control"] = cache_control + ", immutable"
+
+
+def build(outdir=build_dir):
+    """Copy the assets into ``outdir``, adding compressed variants of those
+    worth compressing; return a list of (path, size, gzip size, brotli
+    size)"""
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    built = []
+    for name in asset_dirs:
+        srcroot = os.path.join(here, name)
+        for dirpath, dirnames, filenames in os.walk(srcroot):
+            dstpath = os.path.join(outdir, os.path.relpath(dirpath, here))
+            os.makedirs(dstpath, exist_ok=True)
+            for filename in sorted(filenames):
+                src = os.path.join(dirpath, filename)
+                dst = os.path.join(dstpath, filename)
+                shutil.copyfile(src, dst)
+                with open(src, "rb") as f:
+                    data = f.read()
+                gzsize = brsize = None
+                if filename.endswith(compressible):
+                    compressed = gzip.compress(data, 9, mtime=0)
+                    if len(compressed) < len(data):
+                        gzsize = write(dst + ".gz", compressed)
+                    if brotli is not None:
+                        compressed = brotli.compress(data)
+                        if len(compressed) < len(data):
+                            brsize = write(dst + ".br", compressed)
+                built.append(
+                    (os.path.relpath(src, here), len(data), gzsize, brsize)
+                )
+    return built
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(data)
@@ -74,29 +74,118 @@ def parse_doors(text):
 
 
 def timeslice(period, currtime):
-    low = int(math.floor(currtime)) - period + 1
-    high = int(math.ceil(currtime)) + 1
-    for x in range(low, high):
-        if x % period == 0:
-            return x
+    return int(math.floor(currtime)) // period * period
 
 
 token_valid_secs = 60
+# how long after its slice ends a token is still accepted, so a token fetched
+# just before a slice boundary still works just after it
+token_grace_secs = 30
+token_version = "v1"
 
 
-def make_token(secret, password, valid_secs=token_valid_secs):
-    now = time.time()
-    slice = timeslice(valid_secs, now)
+def make_token(secret, password, valid_secs=token_valid_secs, slice=None):
+    """Return a token of the form ``v1:<slice>:<hmac>``; carrying the slice
+    it was issued in lets it be checked after that slice has ended"""
+    if slice is None:
+        slice = timeslice(valid_secs, time.time())
     timed = password.encode("utf-8") + str(slice).encode("ascii")
-    return hmac.new(secret.encode("utf-8"), timed, "sha512_256").hexdigest()
+    digest = hmac.new(secret.encode("utf-8"), timed, "sha512_256").hexdigest()
+    return f"{token_version}:{slice}:{digest}"
 
 
-def refresh_token(request, username, valid_secs=token_valid_secs):
-    userdata = request.registry.settings["passwords"].get(username.lower())
-    storedhash = userdata["password"]
+def token_slice(token):
+    """Return the slice a token was issued in, or None if it is not a token
+    of the current version"""
+    try:
+        version, slice, digest = token.split(":")
+        if version != token_version:
+            return None
+        return int(slice)
+    except (AttributeError, ValueError):
+        return None
+
+
+class TokenVerifier:
+    """Checks webclient tokens against a table of the expected tokens of every
+    user for each time slice whose tokens are still accepted (the current one
+    and enough previous ones to cover the grace period).  The table is
+    computed once, the first time it is needed after each slice boundary, and
+    is thrown away when the passwords are reloaded; identifications between
+    rollovers cost a couple of dict lookups and a constant-time comparison
+    instead of an HMAC."""
+
+    def __init__(
+        self,
+        secret,
+        passwords,
+        valid_secs=token_valid_secs,
+        grace_secs=token_grace_secs,
+    ):
+        self.secret = secret
+        self.valid_secs = valid_secs
+        self.grace_secs = grace_secs
+        self.reload(passwords)
+
+    def reload(self, passwords):
+        self.passwords = passwords
+        # (slice, {username: {slice: token}}), replaced rather than mutated
+        # so threads sharing the verifier never see a half-built table
+        self.table = (None, {})
+
+    def tokens(self, now):
+        current = timeslice(self.valid_secs, now)
+        tableslice, tokens = self.table
+        if tableslice != current:
+            graceslices = -(-self.grace_secs // self.valid_secs)  # ceil
+            oldest = current - graceslices * self.valid_secs
+            slices = range(oldest, current + 1, self.valid_secs)
+            tokens = {}
+            for username, userdata in self.passwords.items():
+                password = userdata["password"]
+                tokens[username] = {
+                    slice: make_token(
+                        self.secret, password, self.valid_secs, slice
+                    )
+                    for slice in slices
+                }
+            self.table = (current, tokens)
+        return current, tokens
+
+    def token_for(self, username):
+        """Return the current token for ``username`` (None if unknown)"""
+        current, tokens = self.tokens(time.time())
+        expected = tokens.get(username)
+        if expected is None:
+            return None
+        return expected[current]
+
+    def expires(self, token):
+        """Return the time after which ``token`` is no longer accepted"""
+        return token_slice(token) + self.valid_secs + self.grace_secs
+
+    def verify(self, username, token, now=None):
+        if now is None:
+            now = time.time()
+        slice = token_slice(token)
+        if slice is None:
+            return False
+        current, tokens = self.tokens(now)
+        expected = tokens.get(username, {}).get(slice)
+        if expected is None:
+            return False
+        if now >= slice + self.valid_secs + self.grace_secs:
+            return False
+        return hmac.compare_digest(
+            expected.encode("ascii"), token.encode("ascii", "replace")
+        )
+
+
+def refresh_token(request, username):
+    verifier = request.registry.settings["token_verifier"]
+    username = username.lower()
     oldtoken = request.session.get("token")
-    secret = request.registry.settings["secret"]
-    newtoken = make_token(secret, storedhash, valid_secs)
+    newtoken = verifier.token_for(username)
     if oldtoken != newtoken:
         request.session["token"] = newtoken
     return newtoken
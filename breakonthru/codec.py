@@ -0,0 +1,73 @@
+"""Wire codecs for doorserver websocket messages.
+
+Every client identifies with a JSON text frame; it may name a codec in the
+``codec`` key of its identification message, and every frame after that,
+in both directions, is encoded with that codec.  JSON is the default and is
+what browsers use.  MessagePack and CBOR are more compact and cheaper to
+decode, which matters on small Pis and for busy automation clients; they
+need the ``msgpack`` and ``cbor2`` packages respectively."""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class JSONCodec:
+    name = "json"
+    text = True  # frames are sent as websocket text frames
+
+    def encode(self, message):
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    text = False
+
+    def encode(self, message):
+        return msgpack.packb(message)
+
+    def decode(self, frame):
+        return msgpack.unpackb(frame)
+
+
+class CBORCodec:
+    name = "cbor"
+    text = False
+
+    def encode(self, message):
+        return cbor2.dumps(message)
+
+    def decode(self, frame):
+        return cbor2.loads(frame)
+
+
+default_codec = JSONCodec()
+
+codecs = {default_codec.name: default_codec}
+if msgpack is not None:
+    codecs[MsgpackCodec.name] = MsgpackCodec()
+if cbor2 is not None:
+    codecs[CBORCodec.name] = CBORCodec()
+
+
+def get_codec(name):
+    """Return the codec named ``name``, raising a ValueError if it is unknown
+    or its library is not installed"""
+    if name is None:
+        return default_codec
+    codec = codecs.get(name)
+    if codec is None:
+        raise ValueError(f"codec {name} is not available")
+    return codec
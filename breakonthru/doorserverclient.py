@@ -0,0 +1,268 @@
+"""A thread-safe client the webapp uses to send messages to the doorserver.
+
+The webapp keeps a small pool of websocket connections to the doorserver open
+for its lifetime, shared by all of waitress' threads.  Each connection is
+identified once, as a webclient vouched for by the shared secret, so sending
+an unlock costs one websocket frame instead of a login, a token fetch and a
+new connection.  A connection that has dropped is reopened the next time it
+is used.
+
+Unlocks sent with ``unlock`` carry a ``ref``; the doorserver answers with the
+``msgid`` it gave the unlock, which is how the doorclient's acks for it are
+matched up, so callers can wait for a door to be unlocked and relocked.
+
+When ``lockit-server`` runs the webapp and the doorserver in one process,
+LocalDoorserverClient stands in for DoorserverClient and hands messages to
+the doorserver directly."""
+
+import json
+import queue
+import threading
+import time
+import uuid
+
+from websocket import ABNF, WebSocketException, create_connection
+
+from breakonthru.codec import default_codec
+
+
+class PooledConnection:
+    def __init__(self, client):
+        self.client = client
+        self.ws = None
+
+    def connect(self):
+        client = self.client
+        ws = create_connection(client.url, timeout=client.timeout)
+        # identification is always JSON text
+        ws.send(
+            json.dumps(
+                {
+                    "type": "identification",
+                    "body": "webclient",
+                    "secret": client.secret,
+                    "codec": client.codec.name,
+                }
+            )
+        )
+        ws.settimeout(None)  # the reader waits for as long as it takes
+        self.ws = ws
+        reader = threading.Thread(
+            target=self.read, args=(ws,), name="doorserver-reader", daemon=True
+        )
+        reader.start()
+
+    def read(self, ws):
+        """Read frames until the connection drops; this also answers the
+        doorserver's pings, which keeps the connection open while idle"""
+        codec = self.client.codec
+        try:
+            while True:
+                frame = ws.recv()
+                if not frame:
+                    break
+                self.client.receive(codec.decode(frame))
+        except (OSError, WebSocketException):
+            pass
+        finally:
+            ws.close()
+
+    def send(self, message):
+        if self.ws is None or not self.ws.connected:
+            self.connect()
+        codec = self.client.codec
+        opcode = ABNF.OPCODE_TEXT if codec.text else ABNF.OPCODE_BINARY
+        self.ws.send(codec.encode(message), opcode=opcode)
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+            self.ws = None
+
+
+class DoorserverClient:
+    def __init__(self, url, secret, codec=default_codec, size=2, timeout=5):
+        self.url = url
+        self.secret = secret
+        self.codec = codec
+        self.timeout = timeout
+        # LIFO so a quiet webapp keeps reusing the same warm connection
+        self.connections = [PooledConnection(self) for _ in range(size)]
+        self.pool = queue.LifoQueue()
+        for connection in self.connections:
+            self.pool.put(connection)
+        self.lock = threading.Lock()
+        self.waiting = {}  # ref, then msgid -> UnlockStatus
+
+    def send(self, message):
+        """Send ``message`` to the doorserver, reconnecting (once) if the
+        connection turns out to have dropped.  Raises OSError or
+        WebSocketException if the doorserver cannot be reached."""
+        self.send_all([message])
+
+    def send_all(self, messages):
+        """Send several messages back to back over one connection"""
+        connection = self.pool.get()
+        try:
+            pending = list(messages)
+            try:
+                while pending:
+                    connection.send(pending[0])
+                    pending.pop(0)
+            except (OSError, WebSocketException):
+                connection.close()
+                for message in pending:
+                    connection.send(message)
+        except BaseException:
+            connection.close()
+            raise
+        finally:
+            self.pool.put(connection)
+
+    def unlock(self, username, doornums):
+        """Ask the doorserver to unlock each of ``doornums`` on behalf of
+        ``username``, returning an UnlockStatus per door to wait on.  Call
+        ``forget`` with them when done waiting."""
+        statuses = []
+        messages = []
+        with self.lock:
+            for doornum in doornums:
+                status = UnlockStatus(doornum)
+                self.waiting[status.ref] = status
+                statuses.append(status)
+                messages.append(
+                    {
+                        "type": "unlock",
+                        "body": username,
+                        "doornum": doornum,
+                        "ref": status.ref,
+                    }
+                )
+        try:
+            self.send_all(messages)
+        except BaseException:
+            self.forget(statuses)
+            raise
+        return statuses
+
+    def forget(self, statuses):
+        with self.lock:
+            for status in statuses:
+                self.waiting.pop(status.ref, None)
+                self.waiting.pop(status.msgid, None)
+
+    def receive(self, message):
+        """Called in a reader thread with each message from the doorserver"""
+        msgtype = message.get("type")
+        if msgtype == "unlocking":
+            with self.lock:
+                status = self.waiting.pop(message.get("ref"), None)
+                if status is None:
+                    return
+                if message.get("error"):
+                    status.refuse(message["error"])
+                    return
+                status.msgid = message["msgid"]
+                self.waiting[status.msgid] = status
+        elif msgtype == "ack":
+            with self.lock:
+                msgid = message.get("msgid")
+                if message.get("final"):
+                    status = self.waiting.pop(msgid, None)
+                else:
+                    status = self.waiting.get(msgid)
+            if status is not None:
+                status.ack(message.get("final"))
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+class LocalDoorserverClient(DoorserverClient):
+    """A DoorserverClient for a webapp running in the same process as the
+    ``doorserver`` (a Doorserver instance) it talks to: sending is a
+    function call scheduled on the doorserver's event loop, and replies come
+    back the same way, with no websocket or encoding in between."""
+
+    def __init__(self, doorserver):
+        self.doorserver = doorserver
+        self.connection = None
+        self.lock = threading.Lock()
+        self.waiting = {}  # ref, then msgid -> UnlockStatus
+
+    def send_all(self, messages):
+        loop = self.doorserver.loop
+        if loop is None or loop.is_closed():
+            raise ConnectionRefusedError("the doorserver is not running")
+        loop.call_soon_threadsafe(self.dispatch, list(messages))
+
+    def dispatch(self, messages):
+        """Called on the doorserver's event loop"""
+        doorserver = self.doorserver
+        if self.connection is None:
+            self.connection = doorserver.connect_local(self.receive)
+        for message in messages:
+            doorserver.dispatch(self.connection, message)
+
+    def close(self):
+        pass
+
+
+class UnlockStatus:
+    """What has become of one unlock sent by DoorserverClient.unlock; times
+    are ``time.monotonic()`` values"""
+
+    def __init__(self, doornum):
+        self.doornum = doornum
+        self.ref = uuid.uuid4().hex
+        self.msgid = None
+        self.sent = time.monotonic()
+        self.acked = None  # when the doorclient said it got the unlock
+        self.relocked = None  # when the doorclient said it relocked
+        self.error = None  # why the doorserver refused it
+        self.acked_event = threading.Event()
+        self.relocked_event = threading.Event()
+
+    def ack(self, final):
+        now = time.monotonic()
+        if self.acked is None:
+            self.acked = now
+            self.acked_event.set()
+        if final:
+            self.relocked = now
+            self.relocked_event.set()
+
+    def refuse(self, error):
+        self.error = error
+        self.acked_event.set()
+        self.relocked_event.set()
+
+    def wait(self, until, deadline):
+        """Wait until the unlock is acked (``until="ack"``) or relocked
+        (``until="relock"``), but not past the ``time.monotonic()``
+        ``deadline``; return True if it happened in time"""
+        event = self.relocked_event if until == "relock" else self.acked_event
+        return event.wait(max(deadline - time.monotonic(), 0))
+
+    @property
+    def state(self):
+        if self.error is not None:
+            return "refused"
+        if self.relocked is not None:
+            return "relocked"
+        if self.acked is not None:
+            return "acked"
+        return "sent"
+
+    def timings(self):
+        """Milliseconds from sending the unlock to each ack, or None"""
+        return {
+            "ack_ms": self.elapsed_ms(self.acked),
+            "relocked_ms": self.elapsed_ms(self.relocked),
+        }
+
+    def elapsed_ms(self, when):
+        if when is None:
+            return None
+        return round((when - self.sent) * 1000, 3)
@@ -0,0 +1,148 @@
+"""Queues between the doorclient's processes.
+
+A ``multiprocessing.Queue`` can only be waited on by calling ``get``, so a
+process that also has to wait on something else (a websocket, a UART,
+pjsua's output) ends up polling it with a timeout, and each hop adds up to
+that timeout to an unlock.  These queues carry their items over a pipe
+instead, and hand out its read end: it is readable exactly when an item is
+waiting, so it can be given to ``select.poll`` or an asyncio loop's
+``add_reader`` along with everything else the process waits on, and the
+process wakes as soon as an item is put.
+
+When the doorclient runs as a single asyncio process, LocalQueue does the
+same job between its event loop and the threads gpiozero calls back on."""
+
+import collections
+import os
+import pickle
+import queue
+import select
+import struct
+
+
+class Queue:
+    """A queue with any number of producer processes and a single consumer.
+
+    Unlike ``multiprocessing.Queue`` there is no feeder thread, and no lock
+    shared by the producers (one that was killed while holding it would
+    leave every other one stuck): ``put`` pickles the item and writes it to
+    the pipe in a single write, which the kernel keeps whole and apart from
+    anyone else's since items are no longer than PIPE_BUF.  The pipe is
+    nonblocking, so ``put`` never waits on a consumer that has fallen behind
+    or isn't reading; items it can't write wait in an overflow of this
+    process's own, and go out, in order, with its next ``put``.  Only the
+    ``overflow`` newest are kept, the oldest being dropped first."""
+
+    def __init__(self, overflow=100):
+        self.reader, self.writer = os.pipe()
+        os.set_blocking(self.writer, False)
+        self.overflow = collections.deque(maxlen=overflow)
+        self.pid = os.getpid()
+
+    def fileno(self):
+        return self.reader
+
+    def put(self, item):
+        data = pickle.dumps(item)
+        frame = struct.pack("!I", len(data)) + data
+        if len(frame) > select.PIPE_BUF:
+            raise ValueError(f"{len(frame)} bytes is too large to put")
+        if self.pid != os.getpid():
+            # forked; whatever the parent couldn't write is its to write
+            self.pid = os.getpid()
+            self.overflow.clear()
+        self.overflow.append(frame)
+        self.flush()
+
+    def flush(self):
+        """Write as much of the overflow as the pipe has room for"""
+        while self.overflow:
+            try:
+                os.write(self.writer, self.overflow[0])
+            except BlockingIOError:
+                return
+            self.overflow.popleft()
+
+    def get(self, block=True, timeout=None):
+        """Return the next item, waiting up to ``timeout`` seconds (forever
+        if None) for one if ``block``; raise ``queue.Empty`` if there is
+        none"""
+        if not self.poll(timeout if block else 0):
+            raise queue.Empty
+        return self.recv()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self):
+        """Remove and return every item waiting, oldest first"""
+        items = []
+        while self.poll(0):
+            items.append(self.recv())
+        return items
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.reader], [], [], timeout)
+        return bool(readable)
+
+    def recv(self):
+        # each item was written whole, so once its length can be read the
+        # rest of it is there too
+        (size,) = struct.unpack("!I", self.read(4))
+        return pickle.loads(self.read(size))
+
+    def read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = os.read(self.reader, size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+
+class LocalQueue:
+    """A queue with the interface of Queue for use within one process: items
+    stay in a deque, and an eventfd is readable while there are any.  Any
+    thread may put; one consumer gets."""
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+    def fileno(self):
+        return self.fd
+
+    def put(self, item):
+        self.items.append(item)
+        os.eventfd_write(self.fd, 1)
+
+    def clear(self):
+        try:
+            os.eventfd_read(self.fd)
+        except BlockingIOError:
+            pass
+
+    def get(self, block=True, timeout=None):
+        if block and not self.items:
+            select.select([self.fd], [], [], timeout)
+        # cleared before taking, so an item put meanwhile makes the eventfd
+        # readable again rather than going unnoticed
+        self.clear()
+        try:
+            item = self.items.popleft()
+        except IndexError:
+            raise queue.Empty
+        if self.items:
+            os.eventfd_write(self.fd, 1)
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self):
+        self.clear()
+        items = []
+        while self.items:
+            items.append(self.items.popleft())
+        return items
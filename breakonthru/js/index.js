@@ -3,26 +3,18 @@ function logout() {
 }
 
 function buzzDoor(num) {
-    createWebSocket()
     unlockDoor(num)
 }
 
 function unlockDoor(num) {
-    if (window.identified === undefined) {
-        setTimeout(unlockDoor, 100, num)
-    }
-    else {
-        var unlockdata = JSON.stringify(
-            {"type":"unlock",
-             "body":window.tokendata["user"],
-             "doornum":num,}
-        )
-        if (ws.readyState === WebSocket.OPEN) {
-            ws.send(unlockdata)
-        } else if (ws.readyState == WebSocket.CONNECTING) {
-            ws.addEventListener('open', () => ws.send(unlockdata))
-        }
-    }
+    var unlockdata = JSON.stringify(
+        {"type":"unlock",
+         "body":window.tokendata["user"],
+         "doornum":num,}
+    )
+    // sent right away if the websocket is identified, otherwise as soon as
+    // it is, in the order the buttons were pressed
+    createWebSocket().then(ws => ws.send(unlockdata))
 }
 
 function reenableBuzzButton(num) {
@@ -38,17 +30,50 @@ function disableBuzzButton(num) {
     buzzbutton.textContent = "... Buzzing ..."
 }
 
+// The websocket is opened and identified when the page loads and kept open:
+// heartbeats notice when it has silently died, and it is reopened with
+// jittered exponential backoff when it closes, immediately when the page
+// becomes visible again or the network comes back.  door.state is "closed",
+// "connecting" or "identified"; door.ready is a promise of the identified
+// websocket, which stays pending (collecting unlocks) until there is one.
+
+var door = {
+    ws: undefined,
+    state: "closed",
+    attempts: 0,  // failed connection attempts in a row
+    retrytimer: undefined,
+    heartbeat: undefined,
+    lastheard: 0,  // Date.now() of the last message from the doorserver
+}
+
+var heartbeatInterval = 20000
+var heartbeatTimeout = 45000  // nothing heard for this long: it's dead
+var maxBackoff = 30000
+
+function newReady() {
+    door.ready = new Promise(resolve => door.resolveReady = resolve)
+}
+
+newReady()
+
 function createWebSocket() {
-    if (typeof ws !== 'undefined') {
-        if (ws.readyState !== WebSocket.CLOSED  ||
-            ws.readyState !== WebSocket.CLOSING) {
-            return
-        }
+    if (door.state === "closed") {
+        clearTimeout(door.retrytimer)
+        door.state = "connecting"
+        openWebSocket()
     }
-    url = websocket_url; // from index.pt
-    ws = new WebSocket(url)
+    return door.ready
+}
+
+function openWebSocket() {
+    var url = websocket_url // from index.pt
+    var ws = door.ws = new WebSocket(url)
     ws.onmessage = function(event) {
+        door.lastheard = Date.now()
         var message = JSON.parse(event.data)
+        if (message["type"] === "pong") {
+            return
+        }
         if (message["type"] === "ack") {
             body = message["body"]
             if (body.startsWith("unlock")) {
@@ -63,45 +88,137 @@ function createWebSocket() {
         printLog(message["body"])
     }
     ws.onclose = function(event) {
-        ws = undefined
-        window.tokendata = undefined
-        window.identified = undefined
-        printLog("websocket closed")
+        closed(ws)
     }
     ws.onopen = function(event) {
         printLog("websocket opened")
-        fetchTokendata();
-        identify()
+        var token = tokenValid() ? Promise.resolve() : refreshToken()
+        token.then(() => identify(ws))
+    }
+}
+
+function identify(ws) {
+    if (door.ws !== ws || ws.readyState !== WebSocket.OPEN) {
+        return  // closed while we were refreshing the token
+    }
+    printLog("identifying")
+    ws.send(JSON.stringify(
+        {"type":"identification",
+         "body":"webclient",
+         "user":window.tokendata["user"],
+         "token":window.tokendata["token"]}
+          )
+     )
+    door.state = "identified"
+    door.attempts = 0
+    door.lastheard = Date.now()
+    door.heartbeat = setInterval(beat, heartbeatInterval, ws)
+    door.resolveReady(ws)
+}
+
+function beat(ws) {
+    if (Date.now() - door.lastheard > heartbeatTimeout) {
+        printLog("websocket stopped responding")
+        ws.close()
+        closed(ws)  // don't wait for the close handshake on a dead socket
+    }
+    else {
+        ws.send(JSON.stringify({"type":"ping"}))
     }
 }
 
-function fetchTokendata() {
-    window.tokendata = undefined
-    printLog("fetching token data")
+function closed(ws) {
+    if (door.ws !== ws) {
+        return  // already dealt with
+    }
+    clearInterval(door.heartbeat)
+    if (door.state === "identified") {
+        newReady()
+    }
+    door.ws = undefined
+    door.state = "closed"
+    printLog("websocket closed")
+    // full jitter, so phones that lost the server together don't all come
+    // back at the same moment
+    var backoff = Math.min(maxBackoff, 500 * Math.pow(2, door.attempts))
+    door.attempts += 1
+    door.retrytimer = setTimeout(createWebSocket, Math.random() * backoff)
+}
+
+function reconnectNow() {
+    if (door.state === "closed") {
+        door.attempts = 0
+        createWebSocket()
+    }
+    else if (door.state === "identified") {
+        // after a sleep the socket may be dead without anyone having noticed
+        beat(door.ws)
+    }
+}
+
+// the page comes with a token (see index.pt), which is refreshed in the
+// background before it expires, so identifying never waits on /token
+
+// seconds to add to our clock to get the server's
+window.clockskew = 0
+
+function serverNow() {
+    return Date.now() / 1000 + window.clockskew
+}
+
+function tokenValid() {
+    return window.tokendata["expires"] - serverNow() > 5
+}
+
+function scheduleTokenRefresh() {
+    clearTimeout(window.tokentimer)
+    var delay = window.tokendata["expires"] - serverNow() - 20
+    delay = Math.min(Math.max(delay, 5), 60)
+    window.tokentimer = setTimeout(refreshToken, delay * 1000)
+}
+
+function refreshToken() {
     var url = "/token"
-    fetch(url).then(
-        response=>{return response.json()}
+    return fetch(url).then(
+        response=>{
+            if (response.status === 403) {
+                // logged out since this page was loaded (or cached)
+                document.location = "/"
+            }
+            return response.json()
+        }
     ).then(
-        data=> window.tokendata = data
+        data=>{
+            window.clockskew = data["now"] - Date.now() / 1000
+            window.tokendata = data
+            scheduleTokenRefresh()
+        }
+    ).catch(
+        error=>{
+            printLog("could not refresh token: " + error)
+            clearTimeout(window.tokentimer)
+            window.tokentimer = setTimeout(refreshToken, 5000)
+        }
     )
 }
 
-function identify() {
-    window.identified = undefined
-    if (window.tokendata === undefined) {
-        setTimeout(identify, 100)
-    }
-    else {
-        printLog("identifying")
-        ws.send(JSON.stringify(
-            {"type":"identification",
-             "body":"webclient",
-             "user":window.tokendata["user"],
-             "token":window.tokendata["token"]}
-              )
-         )
-        window.identified = true;
+scheduleTokenRefresh()
+
+// timers don't run while a phone is asleep
+document.addEventListener("visibilitychange", () => {
+    if (document.visibilityState === "visible") {
+        if (!tokenValid()) {
+            refreshToken()
+        }
+        reconnectNow()
     }
+})
+
+window.addEventListener("online", reconnectNow)
+
+// caches the page and its assets so it shows up at once next time
+if ("serviceWorker" in navigator) {
+    navigator.serviceWorker.register("/sw.js")
 }
 
 function printLog(msg) {
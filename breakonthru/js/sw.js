@@ -0,0 +1,90 @@
+// The door page's service worker.  VERSION and PRECACHE (the URLs of the
+// page's assets, content-hashed, and of Bootstrap and jQuery) are put in
+// front of this file by the /sw.js view; a new VERSION means new assets, and
+// the caches of older versions are thrown away.
+//
+// The page itself is served from the cache when there is a copy, and
+// refetched in the background to update it, so the buttons show up (and the
+// websocket starts opening) without waiting on a flaky network.  The copy's
+// token may have expired by then; index.js notices and fetches a new one.
+
+var shellURL = "/"
+
+self.addEventListener("install", event => {
+    event.waitUntil(
+        caches.open(VERSION).then(cache => {
+            var assets = cache.addAll(
+                PRECACHE.map(url => new Request(url, {mode: "cors"}))
+            )
+            // the page is only there to cache if someone is logged in
+            var shell = fetch(shellURL).then(
+                response => storeShell(cache, response)
+            ).catch(() => {})
+            return Promise.all([assets, shell])
+        }).then(() => self.skipWaiting())
+    )
+})
+
+self.addEventListener("activate", event => {
+    event.waitUntil(
+        caches.keys().then(names => Promise.all(
+            names.filter(name => name !== VERSION).map(
+                name => caches.delete(name)
+            )
+        )).then(() => self.clients.claim())
+    )
+})
+
+self.addEventListener("fetch", event => {
+    var request = event.request
+    if (request.method !== "GET") {
+        return
+    }
+    var url = new URL(request.url)
+    if (request.mode === "navigate") {
+        if (url.pathname === shellURL) {
+            event.respondWith(shell(event))
+        }
+        else if (url.pathname === "/logout") {
+            // the next person to use this phone must log in
+            event.respondWith(
+                caches.open(VERSION).then(
+                    cache => cache.delete(shellURL)
+                ).then(() => fetch(request))
+            )
+        }
+        return
+    }
+    if (PRECACHE.includes(request.url)) {
+        event.respondWith(
+            caches.match(request).then(cached => cached || fetch(request))
+        )
+    }
+    // anything else (/token in particular) goes to the network as usual
+})
+
+function shell(event) {
+    return caches.open(VERSION).then(cache => {
+        return cache.match(shellURL).then(cached => {
+            var network = fetch(event.request).then(
+                response => storeShell(cache, response)
+            )
+            if (cached) {
+                event.waitUntil(network.catch(() => {}))
+                return cached
+            }
+            return network
+        })
+    })
+}
+
+function storeShell(cache, response) {
+    if (response.ok && !response.redirected) {
+        cache.put(shellURL, response.clone())
+    }
+    else {
+        // logged out (the login form comes back as a 403)
+        cache.delete(shellURL)
+    }
+    return response
+}
@@ -0,0 +1,87 @@
+"""Precomputed index pages.
+
+The index page only depends on who is logged in and on the passwords and
+doors files, which change rarely, so the door list for each user is worked
+out once up front and the page rendered from it is kept, along with a strong
+ETag, until the configuration changes.  A phone that reloads the page gets a
+304 without anything being rendered."""
+
+import collections
+import hashlib
+import threading
+
+token_placeholder = "@@TOKEN@@"
+expires_placeholder = "@@EXPIRES@@"
+
+
+class IndexPages:
+    # host_url comes from the request's Host header, so only the pages for
+    # the few most recently used hosts are kept for each user
+    hosts_per_user = 4
+
+    def __init__(self, passwords, doors, websocket_url, doorsip):
+        self.websocket_url = websocket_url
+        self.doorsip = doorsip
+        self.lock = threading.Lock()
+        self.reload(passwords, doors)
+
+    def reload(self, passwords, doors):
+        models = {}
+        for username, userdata in passwords.items():
+            allowed = set(userdata["doors"])
+            models[username] = {
+                "user": username,
+                "websocket_url": self.websocket_url,
+                "doorsip": self.doorsip,
+                "allowed_doors": userdata["doors"],
+                # the doors this user may open
+                "doors": [
+                    {"doornum": doornum, "name": name}
+                    for doornum, name in enumerate(doors)
+                    if doornum in allowed
+                ],
+            }
+        with self.lock:
+            self.models = models
+            # username -> OrderedDict of host_url -> (body, etag), most
+            # recently used last
+            self.pages = {}
+
+    def model(self, username):
+        return self.models[username]
+
+    def page(self, username, host_url, render, token, expires):
+        """Return ``(body, etag)`` for ``username``'s page with ``token``
+        (which expires at ``expires``) in it, calling ``render(model)`` to
+        render it the first time it is asked for.  The page has absolute URLs
+        in it, so it is kept per ``host_url``, for the last
+        ``hosts_per_user`` of them.
+
+        The token changes every time slice, so the page is rendered with
+        placeholders where the token and its expiry go, and those are filled
+        in for each request.  The ETag has a hash of the token in it, as the
+        token also changes when the user's password does."""
+        with self.lock:
+            model = self.models[username]
+            pages = self.pages.setdefault(username, collections.OrderedDict())
+            page = pages.get(host_url)
+            if page is None:
+                model = dict(model)
+                model["token"] = token_placeholder
+                model["expires"] = expires_placeholder
+                body = render(model).encode("utf-8")
+                etag = hashlib.sha256(body).hexdigest()[:32]
+                page = pages[host_url] = (body, etag)
+                if len(pages) > self.hosts_per_user:
+                    pages.popitem(last=False)
+            else:
+                pages.move_to_end(host_url)
+        body, etag = page
+        body = body.replace(
+            token_placeholder.encode("ascii"), token.encode("ascii")
+        )
+        body = body.replace(
+            expires_placeholder.encode("ascii"), b"%d" % expires
+        )
+        token_hash = hashlib.sha256(token.encode("ascii")).hexdigest()[:16]
+        return body, f"{etag}-{expires}-{token_hash}"
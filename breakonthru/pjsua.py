@@ -0,0 +1,281 @@
+"""Driving pjsua from an asyncio event loop.
+
+pjsua runs under pexpect, but is never waited on with ``expect``: a reader
+on the loop takes its output as it arrives and scans each line for
+registration and call state changes, as well as for the prompts we wait
+for.  PjsuaController keeps one registered pjsua, plus a standby if it is
+given a second config file, and switches pages to the standby the moment
+the active one exits or loses its registration."""
+
+import asyncio
+import re
+import sys
+import time
+
+import pexpect
+
+REGISTERED = "registration success"
+UNREGISTERED = re.compile(r"registration (failed|error)", re.IGNORECASE)
+INCOMING_CALL = "Incoming call for account"
+CALL_STATE = re.compile(r"Call \d+ state changed to (\w+)")
+CALL_DISCONNECTED = re.compile(r"Call \d+ is DISCONNECTED")
+
+
+class Pjsua:
+    """One pjsua process.  ``on_event`` is called with this and one of
+    "registered", "unregistered", "exited", or a call state ("INCOMING",
+    "CALLING", "EARLY", "CONNECTING", "CONFIRMED", "DISCONNECTED")"""
+
+    def __init__(self, name, cmd, logger, on_event):
+        self.name = name
+        self.cmd = cmd
+        self.logger = logger
+        self.on_event = on_event
+        self.child = None
+        self.registered = False
+
+    def log(self, msg, *args):
+        self.logger.info("PJSUA %s " + msg, self.name, *args)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.log("executing %s", self.cmd)
+        self.child = pexpect.spawn(self.cmd, encoding="utf-8")
+        self.child.logfile_read = sys.stdout
+        # sendline would otherwise sleep 50ms, and closing 100ms, stalling
+        # the loop
+        self.child.delaybeforesend = None
+        self.child.ptyproc.delayafterclose = 0
+        self.started = time.monotonic()
+        self.registered = False
+        self.output = ""  # recent output, searched for prompts
+        self.line = ""  # the start of a line not yet ended
+        self.expecting = None  # (text, future) while waiting for text
+        self.exited = loop.create_future()
+        self.first_registration = loop.create_future()
+        self.registration_failed = loop.create_future()
+        loop.add_reader(self.child.child_fd, self.read_output)
+
+    def stop(self):
+        """Make sure the process is gone and reaped"""
+        if self.child is None:
+            return
+        if not self.exited.done():
+            asyncio.get_running_loop().remove_reader(self.child.child_fd)
+            self.exited.set_result(None)
+        self.child.close(force=True)
+        self.registered = False
+
+    def read_output(self):
+        try:
+            # doesn't wait for 1000 bytes, waits for one byte if it's ready
+            data = self.child.read_nonblocking(1000, timeout=0)
+        except pexpect.exceptions.TIMEOUT:
+            return
+        except pexpect.exceptions.EOF:
+            asyncio.get_running_loop().remove_reader(self.child.child_fd)
+            self.registered = False
+            self.exited.set_result(None)
+            if self.expecting is not None:
+                text, future = self.expecting
+                if not future.done():
+                    future.set_exception(
+                        pexpect.exceptions.EOF(f"{self.name} exited")
+                    )
+            self.on_event(self, "exited")
+            return
+        # only as much as the longest prompt we wait for needs to be kept
+        self.output = (self.output + data)[-1000:]
+        if self.expecting is not None:
+            text, future = self.expecting
+            if text in self.output and not future.done():
+                self.output = self.output.split(text, 1)[1]
+                future.set_result(None)
+        lines = (self.line + data).split("\n")
+        self.line = lines.pop()[-1000:]
+        for line in lines:
+            self.scan(line)
+
+    def scan(self, line):
+        if REGISTERED in line:
+            self.registered = True
+            if not self.first_registration.done():
+                self.first_registration.set_result(None)
+            self.on_event(self, "registered")
+        elif UNREGISTERED.search(line):
+            self.registered = False
+            if not self.registration_failed.done():
+                self.registration_failed.set_result(None)
+            self.on_event(self, "unregistered")
+        elif INCOMING_CALL in line:
+            self.on_event(self, "INCOMING")
+        elif CALL_DISCONNECTED.search(line):
+            self.on_event(self, "DISCONNECTED")
+        else:
+            match = CALL_STATE.search(line)
+            if match is not None:
+                self.on_event(self, match.group(1))
+
+    async def expect_output(self, text, timeout=10):
+        """Wait for pjsua to print ``text``"""
+        if text in self.output:
+            self.output = self.output.split(text, 1)[1]
+            return
+        if self.exited.done():
+            raise pexpect.exceptions.EOF(f"{self.name} exited")
+        future = asyncio.get_running_loop().create_future()
+        self.expecting = (text, future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self.expecting = None
+
+    async def call(self, uri):
+        self.output = ""
+        self.child.sendline("m")
+        await self.expect_output("Make call:")
+        self.child.sendline(uri)
+
+
+class PjsuaController:
+    """Keep a registered pjsua, and a registered standby if there are two
+    config files (each must register its own SIP account on its own local
+    port).
+
+    Each config file's pjsua is restarted whenever it exits, fails to
+    register, or later loses its registration, at once the first time and then with a backoff that doubles
+    up to ``max_backoff`` seconds.  Calls go through the active pjsua; when
+    it exits or loses its registration, the standby becomes active
+    straight away.  Registration and call state changes are noticed as
+    pjsua prints them, and call states are passed to ``on_call_state``
+    (with the Pjsua)."""
+
+    def __init__(
+        self,
+        pjsua_bin,
+        config_files,
+        logger,
+        on_call_state,
+        register_timeout=10,
+        max_backoff=30,
+        stable_after=60,
+    ):
+        self.logger = logger
+        self.on_call_state = on_call_state
+        self.register_timeout = register_timeout
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.instances = [
+            Pjsua(
+                f"pjsua{i}",
+                f"{pjsua_bin} --config-file {config_file}",
+                logger,
+                self.event,
+            )
+            for i, config_file in enumerate(config_files)
+        ]
+        self.active = None
+        self.has_active = asyncio.Event()
+
+    def log(self, msg, *args):
+        self.logger.info("PJSUA " + msg, *args)
+
+    async def serve(self):
+        try:
+            await asyncio.gather(*(self.keep(p) for p in self.instances))
+        finally:
+            for pjsua in self.instances:
+                pjsua.stop()
+
+    async def keep(self, pjsua):
+        """Keep ``pjsua`` running and registered"""
+        failures = 0
+        while True:
+            if failures:
+                delay = min(0.1 * 2 ** (failures - 1), self.max_backoff)
+                self.log("restarting %s in %.1fs", pjsua.name, delay)
+                await asyncio.sleep(delay)
+            pjsua.start()
+            await asyncio.wait(
+                [
+                    pjsua.first_registration,
+                    pjsua.registration_failed,
+                    pjsua.exited,
+                ],
+                timeout=self.register_timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not pjsua.registered or pjsua.registration_failed.done():
+                self.log("%s registration failure", pjsua.name)
+                pjsua.stop()
+                failures += 1
+                continue
+            # a pjsua that can't re-register is no better than one that
+            # exited, and pjsua left to retry may take a while to recover
+            await asyncio.wait(
+                [pjsua.registration_failed, pjsua.exited],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            uptime = time.monotonic() - pjsua.started
+            if pjsua.exited.done():
+                self.log("%s exited after %.1fs", pjsua.name, uptime)
+            else:
+                self.log(
+                    "%s lost its registration after %.1fs", pjsua.name, uptime
+                )
+            pjsua.stop()
+            failures = 0 if uptime >= self.stable_after else failures + 1
+
+    def event(self, pjsua, event):
+        if event == "registered":
+            self.log("%s registration success", pjsua.name)
+            if self.active is None or not self.active.registered:
+                self.activate(pjsua)
+        elif event in ("unregistered", "exited"):
+            self.log("%s %s", pjsua.name, event)
+            if pjsua is self.active:
+                self.failover()
+        else:
+            self.on_call_state(pjsua, event)
+
+    def activate(self, pjsua):
+        self.active = pjsua
+        self.has_active.set()
+        self.log("%s is active", pjsua.name)
+
+    def failover(self):
+        for pjsua in self.instances:
+            if pjsua is not self.active and pjsua.registered:
+                self.activate(pjsua)
+                return
+        self.active = None
+        self.has_active.clear()
+        self.logger.warning("PJSUA no registered pjsua")
+
+    async def call(self, uri):
+        """Call ``uri`` through the active pjsua, waiting up to
+        ``register_timeout`` seconds for one to be registered, and trying
+        again through the standby (or the restarted pjsua) if the active
+        one exits meanwhile.  Return whether the call was made."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.register_timeout
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.has_active.wait(), deadline - loop.time()
+                )
+            except asyncio.TimeoutError:
+                break
+            pjsua = self.active
+            if pjsua is None:
+                continue  # it exited while we were waking up
+            try:
+                await pjsua.call(uri)
+                return True
+            except pexpect.exceptions.EOF:
+                self.log("%s exited while calling %s", pjsua.name, uri)
+            except asyncio.TimeoutError:
+                self.log("%s did not prompt for a call", pjsua.name)
+                break
+        self.logger.warning("PJSUA could not call %s", uri)
+        return False
@@ -0,0 +1,20 @@
+import argparse
+
+from breakonthru.assets import brotli, build, build_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy the webapp's static assets into a build directory "
+        "with precompressed variants"
+    )
+    parser.add_argument(
+        "--outdir",
+        help=f"Directory to build into (default {build_dir})",
+        default=build_dir,
+    )
+    args = parser.parse_args()
+    if brotli is None:
+        print("brotli is not installed, only making gzip variants")
+    for path, size, gzsize, brsize in build(args.outdir):
+        print(f"{path:30} {size:8} gz {gzsize or '-':>8} br {brsize or '-':>8}")
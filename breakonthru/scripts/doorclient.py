@@ -1,15 +1,16 @@
 import asyncio
 import configparser
 import gpiozero
+import heapq
 import io
 import json
+import multiprocessing.connection
 import os
-import pexpect
 import queue
+import random
 import select
 import setproctitle
 import signal
-import socket
 import sys
 import termios
 import time
@@ -17,9 +18,12 @@ import tty
 import websockets
 import websockets.exceptions
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 
-from breakonthru.util import teelogger
+from breakonthru.codec import get_codec
+from breakonthru.ipc import LocalQueue, Queue
+from breakonthru.pjsua import PjsuaController
+from breakonthru.util import log_backups, log_max_bytes, teelogger
 
 LF = b"\n"
 CR = b"\r"
@@ -43,7 +47,10 @@ class UnlockListener:
         server,
         secret,
         clientidentity,
+        doors,
+        codec,
         logger,
+        max_backoff=30,
     ):
         self.unlock_queue = unlock_queue
         self.relock_queue = relock_queue
@@ -51,32 +58,67 @@ class UnlockListener:
         self.server = server
         self.secret = secret
         self.clientidentity = clientidentity
+        self.doors = doors
+        self.codec = get_codec(codec)
         self.logger = logger
+        self.max_backoff = max_backoff
 
-    def log(self, msg):
-        self.logger.info(f"UNLKL {msg}")
+    def log(self, msg, *args):
+        self.logger.info("UNLKL " + msg, *args)
+
+    async def send(self, websocket, message):
+        await websocket.send(self.codec.encode(message), text=self.codec.text)
+
+    def decode(self, frame):
+        if isinstance(frame, str):
+            return json.loads(frame)
+        return self.codec.decode(frame)
 
     def run(self):
         setproctitle.setproctitle("doorclient-unlocklistener")
         try:
-            self.log("starting unlock listener")
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            return
+
+    async def serve_forever(self):
+        self.log("starting unlock listener")
+        self.attempts = 0  # connections in a row that failed or dropped
+        loop = asyncio.get_running_loop()
+        # while we aren't connected, broadcasts have no one to go to, and
+        # would be stale by the time we were; throw them away so they don't
+        # pile up in the queue
+        loop.add_reader(
+            self.broadcast_queue.fileno(), self.broadcast_queue.drain
+        )
+        try:
             while True:
-                # serve exits if doorserver is disconnected, just reestablish
-                # a connection in this case via this loop
+                # serve exits if doorserver is disconnected, just
+                # reestablish a connection in this case via this loop
                 try:
-                    asyncio.run(self.serve())
+                    await self.serve()
                 except (
                     websockets.exceptions.ConnectionClosedError,
-                    websockets.exceptions.InvalidStatusCode,
+                    websockets.exceptions.InvalidHandshake,
                     asyncio.TimeoutError,
-                    socket.gaierror,
-                ):
-                    pass
-        except KeyboardInterrupt:
-            return
+                    OSError,  # refused, reset, unresolvable, unreachable
+                ) as e:
+                    self.logger.warning(
+                        "UNLKL connection to %s failed: %r", self.server, e
+                    )
+                # full jitter, so doorclients that lost the doorserver
+                # together don't all come back at the same moment
+                backoff = min(self.max_backoff, 0.5 * 2**self.attempts)
+                self.attempts += 1
+                delay = random.uniform(0, backoff)
+                self.log("reconnecting in %.1fs", delay)
+                await asyncio.sleep(delay)
+        finally:
+            loop.remove_reader(self.broadcast_queue.fileno())
 
     async def serve(self):
         async with websockets.connect(self.server) as websocket:
+            self.attempts = 0
             self.log("sending identification")
             await websocket.send(
                 json.dumps(
@@ -84,61 +126,41 @@ class UnlockListener:
                         "type": "identification",
                         "body": self.clientidentity,
                         "secret": self.secret,
+                        "doors": self.doors,
+                        "codec": self.codec.name,
                     }
                 )
             )
-            lasttime = 0
-            awaiting_relock = {}
-            while True:
-                now = time.time()
-                try:
-                    message = await asyncio.wait_for(
-                        websocket.recv(), timeout=0.25
+            # everything we send goes through here, so one task does the
+            # writing and acks go out in the order they were made
+            outgoing = asyncio.Queue()
+
+            def relocked():
+                for when, doornum, msgid in self.relock_queue.drain():
+                    if msgid is None:
+                        continue  # unlocked by a signal (enqueue_unlock_*)
+                    outgoing.put_nowait(
+                        {
+                            "type": "ack",
+                            "msgid": msgid,
+                            "final": True,
+                            "body": f"relocked door {doornum}",
+                        }
                     )
-                except websockets.ConnectionClosedOK:
-                    self.log("connection closed ok")
-                    break
-                except asyncio.TimeoutError:
-                    if now > (lasttime + 30):
-                        # keepalive every 30 seconds
-                        lasttime = now
-                        await websocket.pong()
-                    try:
-                        bmesg = self.broadcast_queue.get(block=False)
-                    except queue.Empty:
-                        pass
-                    else:
-                        await websocket.send(
-                            json.dumps(
-                                {
-                                    "type": "broadcast",
-                                    "body": bmesg,
-                                }
-                            )
-                        )
-
-                    if awaiting_relock:
-                        try:
-                            when, doornum = self.relock_queue.get(block=False)
-                        except queue.Empty:
-                            continue
-                        relock_msgid = awaiting_relock.pop(doornum, None)
-                        if relock_msgid is None:
-                            continue
-                        await websocket.send(
-                            json.dumps(
-                                {
-                                    "type": "ack",
-                                    "msgid": relock_msgid,
-                                    "final": True,
-                                    "body": f"relocked door {doornum}",
-                                }
-                            )
-                        )
 
-                else:
+            def broadcast():
+                for bmesg in self.broadcast_queue.drain():
+                    outgoing.put_nowait({"type": "broadcast", "body": bmesg})
+
+            # woken as soon as the executor relocks or the pager broadcasts
+            loop = asyncio.get_running_loop()
+            loop.add_reader(self.relock_queue.fileno(), relocked)
+            loop.add_reader(self.broadcast_queue.fileno(), broadcast)
+            sender = asyncio.create_task(self.sender(websocket, outgoing))
+            try:
+                async for message in websocket:
                     self.log("got websocket message")
-                    message = json.loads(message)
+                    message = self.decode(message)
                     serverprovidedsecret = message.get("secret")
                     if serverprovidedsecret == self.secret:
                         msgtype = message.get("type")
@@ -151,19 +173,34 @@ class UnlockListener:
                                 f"door {doornum}"
                             )
                             when = time.time()
-                            self.unlock_queue.put((when, doornum))
-                            self.log(f"enqueued {character}")
-                            awaiting_relock[doornum] = msgid
-                            await websocket.send(
-                                json.dumps(
-                                    {
-                                        "type": "ack",
-                                        "msgid": msgid,
-                                        "body": character,
-                                    }
-                                )
+                            self.unlock_queue.put((when, doornum, msgid))
+                            self.log("enqueued %s", character)
+                            outgoing.put_nowait(
+                                {
+                                    "type": "ack",
+                                    "msgid": msgid,
+                                    "body": character,
+                                }
                             )
-                            self.log("sent ack")
+                self.log("connection closed ok")
+            finally:
+                loop.remove_reader(self.relock_queue.fileno())
+                loop.add_reader(
+                    self.broadcast_queue.fileno(), self.broadcast_queue.drain
+                )
+                sender.cancel()
+
+    async def sender(self, websocket, outgoing):
+        while True:
+            try:
+                message = await asyncio.wait_for(outgoing.get(), timeout=30)
+            except asyncio.TimeoutError:
+                # keepalive every 30 seconds
+                await websocket.pong()
+                continue
+            await self.send(websocket, message)
+            if message["type"] == "ack" and not message.get("final"):
+                self.log("sent ack")
 
 
 class ReyaxBuzzer:
@@ -177,6 +214,9 @@ class ReyaxBuzzer:
     def off(self):
         pass
 
+    def close(self):
+        pass
+
 
 class UnlockExecutor:
     def __init__(
@@ -195,8 +235,8 @@ class UnlockExecutor:
         self.door_unlocked_duration = door_unlocked_duration
         self.logger = logger
 
-    def log(self, msg):
-        self.logger.info(f"UNLKX {msg}")
+    def log(self, msg, *args):
+        self.logger.info("UNLKX " + msg, *args)
 
     def run(self):
         setproctitle.setproctitle("doorclient-unlockexecutor")
@@ -205,42 +245,112 @@ class UnlockExecutor:
         except KeyboardInterrupt:
             return
 
-    def _run(self):
+    def buzzer(self, pin):
+        if pin.startswith("reyax:"):
+            address = int(pin[6:])
+            return ReyaxBuzzer(address, self.reyax_queue)
+        return gpiozero.Buzzer(int(pin))
+
+    def setup(self):
         self.log("starting unlock executor")
-        self.log(f"unlock gpio pins are {self.unlock_gpio_pins}")
-        last_relock_times = {}
+        self.log("unlock gpio pins are %s", self.unlock_gpio_pins)
         # gpiozero objects cannot be defined in the main process, only in
         # subproc
-        buzzers = []
-        for pin in self.unlock_gpio_pins:
-            if pin.startswith("reyax:"):
-                address = int(pin[6:])
-                buzzers.append(ReyaxBuzzer(address, self.reyax_queue))
-            else:
-                buzzers.append(gpiozero.Buzzer(int(pin)))
-        while True:
-            try:
-                while True:
-                    when, doornum = self.unlock_queue.get(timeout=0.5)
-                    if when > last_relock_times.get(doornum, 0):
-                        break
-            except queue.Empty:
-                continue
+        self.buzzers = {}
+        for doornum, pin in self.unlock_gpio_pins.items():
+            self.buzzers[doornum] = self.buzzer(pin)
+        # doornum -> [relock deadline, {msgid: when} of each unlock it was
+        # opened or held open for]
+        self.unlocked = {}
 
-            now = time.time()
-            self.log(f"unlocking door {doornum}")
-            buzzer = buzzers[doornum]
-            try:
-                buzzer.on()
-                self.log(
-                    f"waiting {self.door_unlocked_duration} before relocking"
-                )
-                time.sleep(self.door_unlocked_duration)
-            finally:
-                buzzer.off()
-                self.log(f"relocked door {doornum}")
-                self.relock_queue.put((now, doornum))
-                last_relock_times[doornum] = now
+    def _run(self):
+        self.setup()
+        # (deadline, doornum), one per unlock; entries whose deadline was
+        # pushed back by a later unlock of the same door are skipped
+        deadlines = []
+        try:
+            while True:
+                timeout = None
+                if deadlines:
+                    timeout = max(deadlines[0][0] - time.monotonic(), 0)
+                try:
+                    when, doornum, msgid = self.unlock_queue.get(
+                        timeout=timeout
+                    )
+                except queue.Empty:
+                    pass
+                else:
+                    deadline = self.unlock(when, doornum, msgid)
+                    if deadline is not None:
+                        heapq.heappush(deadlines, (deadline, doornum))
+                now = time.monotonic()
+                while deadlines and deadlines[0][0] <= now:
+                    deadline, doornum = heapq.heappop(deadlines)
+                    self.expire(doornum, deadline)
+        finally:
+            self.relock_all()
+
+    async def serve(self):
+        """Run in an event loop instead, whose timers stand in for the heap
+        of deadlines"""
+        self.setup()
+        loop = asyncio.get_running_loop()
+
+        def unlocks():
+            for when, doornum, msgid in self.unlock_queue.drain():
+                deadline = self.unlock(when, doornum, msgid)
+                if deadline is not None:
+                    # time.monotonic() is the loop's clock
+                    loop.call_at(deadline, self.expire, doornum, deadline)
+
+        loop.add_reader(self.unlock_queue.fileno(), unlocks)
+        try:
+            await asyncio.Future()  # run forever
+        finally:
+            loop.remove_reader(self.unlock_queue.fileno())
+            self.relock_all()
+            # free the pins, so they can be set up again if we are restarted
+            for buzzer in self.buzzers.values():
+                buzzer.close()
+
+    def unlock(self, when, doornum, msgid):
+        """Unlock the door, or keep it unlocked if it already is; return
+        when it is now due to be relocked (None if there is no such door)"""
+        buzzer = self.buzzers.get(doornum)
+        if buzzer is None:
+            self.log("no unlock pin for door %s", doornum)
+            return None
+        deadline = time.monotonic() + self.door_unlocked_duration
+        door = self.unlocked.get(doornum)
+        if door is None:
+            self.log("unlocking door %s", doornum)
+            self.unlocked[doornum] = [deadline, {msgid: when}]
+        else:
+            self.log("keeping door %s unlocked", doornum)
+            door[0] = deadline
+            door[1].setdefault(msgid, when)
+        # a no-op for a pin that is already on; a reyax door restarts its
+        # own relock timer
+        buzzer.on()
+        return deadline
+
+    def expire(self, doornum, deadline):
+        """Relock the door if ``deadline`` is still when it is due"""
+        door = self.unlocked.get(doornum)
+        if door is not None and door[0] == deadline:
+            self.relock(doornum)
+
+    def relock(self, doornum):
+        deadline, requests = self.unlocked.pop(doornum)
+        self.buzzers[doornum].off()
+        self.log("relocked door %s", doornum)
+        # one relock per unlock asked for, so each gets its final ack
+        for msgid, when in requests.items():
+            self.relock_queue.put((when, doornum, msgid))
+
+    def relock_all(self):
+        for doornum in list(self.unlocked):
+            self.relock(doornum)
 
 
 class PageListener:
@@ -256,35 +366,49 @@ class PageListener:
         self.callbutton_bouncetime = callbutton_bouncetime
         self.logger = logger
 
-    def log(self, msg):
-        self.logger.info(f"PAGEL {msg}")
+    def log(self, msg, *args):
+        self.logger.info("PAGEL " + msg, *args)
 
     def run(self):
         setproctitle.setproctitle("doorclient-pagelistener")
         # gpiozero objects cannot be defined in the main process, only in
         # subproc
         try:
-            self.log("starting page listener")
-            self.log(f"callbutton gpio pin is {self.callbutton_gpio_pin}")
-            button = gpiozero.Button(
-                pin=self.callbutton_gpio_pin,
-                bounce_time=self.callbutton_bouncetime / 1000.0,
-            )
-            self.log("button set up properly")
-
-            def enqueue(*arg):
-                now = time.time()
-                self.logger.debug("enqueuing page")
-                self.page_queue.put(now)
-                self.log("enqueued page")
-
-            button.when_pressed = enqueue
+            self.setup()
             signal.pause()
         except KeyboardInterrupt:
             pass
 
+    def setup(self):
+        """Start listening for the call button; gpiozero calls back on a
+        thread of its own, which only has to put the page request on
+        ``page_queue``"""
+        self.log("starting page listener")
+        self.log("callbutton gpio pin is %s", self.callbutton_gpio_pin)
+        self.button = gpiozero.Button(
+            pin=self.callbutton_gpio_pin,
+            bounce_time=self.callbutton_bouncetime / 1000.0,
+        )
+        self.log("button set up properly")
+
+        def enqueue(*arg):
+            now = time.time()
+            self.logger.debug("enqueuing page")
+            self.page_queue.put(now)
+            self.log("enqueued page")
+
+        self.button.when_pressed = enqueue
+
 
 class PageExecutor:
+    # broadcast to the webclients as pjsua reports them
+    call_states = {
+        "INCOMING": "SIP: incoming call",
+        "EARLY": "SIP: call ringing",
+        "CONFIRMED": "SIP: call answered",
+        "DISCONNECTED": "SIP: call hung up",
+    }
+
     def __init__(
         self,
         page_queue,
@@ -294,75 +418,85 @@ class PageExecutor:
         pagingsip,
         page_throttle_duration,
         logger,
+        pjsua_standby_config_file=None,
     ):
         self.page_queue = page_queue
         self.broadcast_queue = broadcast_queue
         self.pjsua_bin = pjsua_bin
         self.pjsua_config_file = pjsua_config_file
+        self.pjsua_standby_config_file = pjsua_standby_config_file
         self.pagingsip = pagingsip
         self.page_throttle_duration = page_throttle_duration
         self.logger = logger
 
-    def log(self, msg):
-        self.logger.info(f"PAGEX {msg}")
+    def log(self, msg, *args):
+        self.logger.info("PAGEX " + msg, *args)
 
     def run(self):
         setproctitle.setproctitle("doorclient-pageexecutor")
         try:
-            self._run()
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             return
 
-    def _run(self):
+    async def serve(self):
         self.log("starting page executor")
-
-        for i in range(0, 9):
-            self.log(
-                f"pjsua attempting to register with asterisk, try number {i}"
-            )
-            try:
-                cmd = f"{self.pjsua_bin} --config-file {self.pjsua_config_file}"
-                self.log(f"executing {cmd}")
-                self.child = pexpect.spawn(cmd, encoding="utf-8", timeout=10)
-                self.child.logfile_read = sys.stdout
-                # fail if not successful
-                self.child.expect("registration success")
-                self.log("pjsua registration success")
-                break
-            except pexpect.exceptions.TIMEOUT:
-                self.log("pjsua registration failure, retrying")
-                self.child.terminate()
-                continue
-        else:  # nobreak
-            raise AssertionError("could not register with SIP provider")
-
-        last_page_time = 0
-
-        while True:
-            # see all output more quickly, for debugging
-            try:
-                # doesn't wait for 1000 bytes, waits for one byte if it's ready
-                self.child.read_nonblocking(1000, timeout=0)
-            except pexpect.exceptions.TIMEOUT:
-                pass
-
-            try:
-                request = self.page_queue.get(timeout=0.5)
-            except queue.Empty:
-                continue
-
-            if request > (last_page_time + self.page_throttle_duration):
-                last_page_time = time.time()
-                self.log("Paging")
-                self.page()
-            else:
-                self.log(f"Throttled page request from time {request}")
-
-    def page(self):
+        config_files = [self.pjsua_config_file]
+        if self.pjsua_standby_config_file:
+            config_files.append(self.pjsua_standby_config_file)
+        self.pjsua = PjsuaController(
+            self.pjsua_bin, config_files, self.logger, self.call_state
+        )
+        tasks = [
+            asyncio.ensure_future(self.pjsua.serve()),
+            asyncio.ensure_future(self.handle_pages()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # if one fails, stop the other too, so no pjsua is left running
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle_pages(self):
+        self.last_page_time = 0
+        loop = asyncio.get_running_loop()
+        requests = asyncio.Queue()
+
+        def queued():
+            # empty the pipe as requests arrive, even while we are paging,
+            # or the reader would be called over and over until we were done
+            for request in self.page_queue.drain():
+                requests.put_nowait(request)
+
+        loop.add_reader(self.page_queue.fileno(), queued)
+        try:
+            while True:
+                request = await requests.get()
+                if self.should_page(request):
+                    await self.page()
+        finally:
+            loop.remove_reader(self.page_queue.fileno())
+
+    def should_page(self, request):
+        if request > (self.last_page_time + self.page_throttle_duration):
+            self.last_page_time = time.time()
+            self.log("Paging")
+            return True
+        self.log("Throttled page request from time %s", request)
+        return False
+
+    async def page(self):
         self.broadcast_queue.put("SIP: paging all connected handsets")
-        self.child.sendline("m")
-        self.child.expect("Make call:")
-        self.child.sendline(self.pagingsip)
+        if not await self.pjsua.call(self.pagingsip):
+            self.broadcast_queue.put("SIP: paging failed")
+
+    def call_state(self, pjsua, state):
+        self.log("%s call state %s", pjsua.name, state)
+        message = self.call_states.get(state)
+        if message is not None:
+            self.broadcast_queue.put(message)
 
 
 class ReyaxDoorTransmitter:
@@ -407,15 +541,19 @@ class ReyaxDoorTransmitter:
         self.uart = uart
         self.buffer = bytearray()
         self.pending_commands = list(commands)  # dont mutate the original
+        self.current_cmd = None  # the command we are waiting on a reply to
+        self.expect = None  # the reply it should get
         self.poller = select.poll()
         self.poller.register(uart, select.POLLIN)
+        # so an unlock is sent as soon as it is queued
+        self.poller.register(reyax_queue, select.POLLIN)
 
-    def log(self, msg):
-        self.logger.info(f"REYXTR {msg}")
+    def log(self, msg, *args):
+        self.logger.info("REYXTR " + msg, *args)
 
     def handle_message(self, address, message):
         self.relocked[address] = message
-        self.log(f"RECEIVED {message} from {address}")
+        self.log("RECEIVED %s from %s", message, address)
 
     def manage_state(self):
         now = time.time()
@@ -426,9 +564,13 @@ class ReyaxDoorTransmitter:
                 self.unlocking.pop(address)
                 reply = self.relocked.pop(address, None)
                 if reply is None:
-                    self.logger.warn(f"No relock response from reyax {address}")
+                    self.logger.warning(
+                        "No relock response from reyax %s", address
+                    )
                 else:
-                    self.log(f"Relock response from reyax {address}: {reply}")
+                    self.log(
+                        "Relock response from reyax %s: %s", address, reply
+                    )
         try:
             address = self.reyax_queue.get(block=False)
             self.unlocking[address] = now
@@ -436,79 +578,104 @@ class ReyaxDoorTransmitter:
             return
         msglen = len(self.unlock_msg)
         cmd = f"AT+SEND={address},{msglen},{self.unlock_msg}"
-        self.log(f"sending {cmd} to {address}")
+        self.log("sending %s to %s", cmd, address)
         self.pending_commands.append((cmd, ""))
 
     def runforever(self):
-        # initialize some variables we use later
-        current_cmd = None
-        expect = None
-
         while True:
             # continually call manage_state to maybe relock and maybe blink led
             self.manage_state()
+            self.send_next()
 
-            if self.pending_commands and current_cmd is None:
-                # if there are any commands in our command list and we aren't
-                # already processing a command, pop the first command
-                # from the command list and send it to the Reyax
-                current_cmd, expect = self.pending_commands.pop(0)
-                self.log(current_cmd)
-                # current_cmd is a string, but the UART expects bytes, so
-                # we need to encode it to a bytes object
-                current_cmd_bytes = current_cmd.encode()
-                self.uart.write(current_cmd_bytes + CRLF)
-
-            events = self.poller.poll(1000)  # wait 1 sec for any data (1000ms)
-            for obj, flag in events:
-                if flag & select.POLLIN:
-                    # There is data available to be read on our UART.
-                    # Continually add any data read from the UART to our buffer
-                    data = self.uart.read()
-                    self.buffer = self.buffer + data
-
-                    # process whatever's in the buffer
-                    while LF in self.buffer:
-                        # We consider any data between two linefeeds to be a
-                        # response
-                        line, self.buffer = self.buffer.split(LF, 1)
-                        line = line.strip(CR)  # strip any trailing carriage rtn
-                        resp = line.decode("ascii", "replace")  # bytes to text
-                        self.log(resp)
-
-                        if resp.startswith("+RCV="):
-                            # Usually we get a response to one of our own AT
-                            # commands when we process a full line, but this is
-                            # not one of those.  Instead, it is a message from
-                            # the sender e.g.  "+RCV=50,5,HELLO,-99,40"
-                            # (although in practice this is probably a door
-                            # unlock request, and the message would not be
-                            # "HELLO")
-
-                            address, length, rest = resp[5:].split(",", 2)
-
-                            # address will be "50", length will be "5"
-                            # "rest" will be "HELLO,-99,40"
-
-                            address = int(address)
-                            datalen = int(length)
-                            message = rest[:datalen]  # message will be "HELLO"
-
-                            # call handle_message to process the message
-                            self.handle_message(address, message)
-
-                        elif resp and expect:
-                            # if we were expecting a response to a command,
-                            # compare the response against the expected value
-                            # and raise an AssertionError if it's not the
-                            # same
-                            if resp != expect:
-                                msg = f"expect {repr(expect)},got {repr(resp)}"
-                                raise AssertionError(msg)
-
-                        # we have finished processing a command
-                        current_cmd = None
-                        expect = None
+            # wait up to 1 sec (1000ms) for UART data or a queued unlock
+            events = self.poller.poll(1000)
+            for fd, flag in events:
+                if fd == self.uart.fileno() and flag & select.POLLIN:
+                    self.read_uart()
+
+    async def serve(self):
+        """Run in an event loop instead, woken by the same things"""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        loop.add_reader(self.uart.fileno(), wakeup.set)
+        loop.add_reader(self.reyax_queue.fileno(), wakeup.set)
+        try:
+            while True:
+                self.manage_state()
+                self.send_next()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                self.read_uart()
+        finally:
+            loop.remove_reader(self.uart.fileno())
+            loop.remove_reader(self.reyax_queue.fileno())
+            self.uart.close()
+
+    def send_next(self):
+        if self.pending_commands and self.current_cmd is None:
+            # if there are any commands in our command list and we aren't
+            # already processing a command, pop the first command
+            # from the command list and send it to the Reyax
+            self.current_cmd, self.expect = self.pending_commands.pop(0)
+            self.log(self.current_cmd)
+            # current_cmd is a string, but the UART expects bytes, so
+            # we need to encode it to a bytes object
+            current_cmd_bytes = self.current_cmd.encode()
+            self.uart.write(current_cmd_bytes + CRLF)
+
+    def read_uart(self):
+        # Continually add any data read from the UART to our buffer; the
+        # UART is nonblocking, so there may be none
+        data = self.uart.read()
+        if not data:
+            return
+        self.buffer = self.buffer + data
+
+        # process whatever's in the buffer
+        while LF in self.buffer:
+            # We consider any data between two linefeeds to be a
+            # response
+            line, self.buffer = self.buffer.split(LF, 1)
+            line = line.strip(CR)  # strip any trailing carriage rtn
+            resp = line.decode("ascii", "replace")  # bytes to text
+            self.log(resp)
+
+            if resp.startswith("+RCV="):
+                # Usually we get a response to one of our own AT
+                # commands when we process a full line, but this is
+                # not one of those.  Instead, it is a message from
+                # the sender e.g.  "+RCV=50,5,HELLO,-99,40"
+                # (although in practice this is probably a door
+                # unlock request, and the message would not be
+                # "HELLO")
+
+                address, length, rest = resp[5:].split(",", 2)
+
+                # address will be "50", length will be "5"
+                # "rest" will be "HELLO,-99,40"
+
+                address = int(address)
+                datalen = int(length)
+                message = rest[:datalen]  # message will be "HELLO"
+
+                # call handle_message to process the message
+                self.handle_message(address, message)
+
+            elif resp and self.expect:
+                # if we were expecting a response to a command,
+                # compare the response against the expected value
+                # and raise an AssertionError if it's not the
+                # same
+                if resp != self.expect:
+                    msg = f"expect {repr(self.expect)},got {repr(resp)}"
+                    raise AssertionError(msg)
+
+            # we have finished processing a command
+            self.current_cmd = None
+            self.expect = None
 
 
 class ReyaxTransmissionHandler:
@@ -518,8 +685,8 @@ class ReyaxTransmissionHandler:
         self.reyax_queue = reyax_queue
         self.logger = logger
 
-    def log(self, msg):
-        self.logger.info(f"REYXTH {msg}")
+    def log(self, msg, *args):
+        self.logger.info("REYXTH " + msg, *args)
 
     def run(self):
         setproctitle.setproctitle("reyax-transmission-handler")
@@ -529,9 +696,15 @@ class ReyaxTransmissionHandler:
             return
 
     def _run(self):
+        self.transmitter().runforever()
+
+    async def serve(self):
+        await self.transmitter().serve()
+
+    def transmitter(self):
         self.log("starting reyax transmitter")
         cfg = self.reyax_config
-        self.log(f"reyax config is {cfg}")
+        self.log("reyax config is %s", cfg)
         OK = "+OK"
         commands = [
             ("AT", ""),  # flush any old data pending CRLF
@@ -543,7 +716,7 @@ class ReyaxTransmissionHandler:
             ),  # baudrate
             (f'AT+ADDRESS={cfg["address"]}', OK),
         ]
-        tx = ReyaxDoorTransmitter(
+        return ReyaxDoorTransmitter(
             self.logger,
             self.reyax_queue,
             commands=commands,
@@ -552,7 +725,6 @@ class ReyaxTransmissionHandler:
             unlock_msg=cfg["unlock_msg"],
             unlocked_duration=self.unlocked_duration,
         )
-        tx.runforever()
 
 
 unlock_queue = Queue()
@@ -562,6 +734,152 @@ broadcast_queue = Queue()
 reyax_queue = Queue()
 
 
+class Supervisor:
+    """Run each role in its own process, restarting any that exits.
+
+    Exits are noticed at once, by waiting on the processes' sentinels, and
+    only the role that exited is restarted: at once the first time, then
+    after a backoff that doubles with each restart in a row, up to
+    ``max_backoff`` seconds, so a role that cannot start (a missing UART,
+    say) doesn't spin.  A role that stayed up ``stable_after`` seconds
+    before exiting is restarted at once again.  Each role's restart count
+    and uptime are logged whenever one restarts, and on SIGHUP."""
+
+    def __init__(
+        self, logger, min_backoff=0.1, max_backoff=30, stable_after=60
+    ):
+        self.logger = logger
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.roles = {}
+
+    def log(self, msg, *args):
+        self.logger.info("SUPRV " + msg, *args)
+
+    def add(self, name, target):
+        self.roles[name] = {
+            "target": target,
+            "proc": None,
+            "started": None,  # time.monotonic() of the last start
+            "restarts": 0,
+            "failures": 0,  # restarts in a row, for the backoff
+            "restart_at": time.monotonic(),
+        }
+
+    def start(self, name):
+        role = self.roles[name]
+        proc = Process(name=name, target=role["target"], daemon=True)
+        proc.start()
+        role["proc"] = proc
+        role["started"] = time.monotonic()
+        role["restart_at"] = None
+        self.log("started %s pid %s", name, proc.pid)
+
+    def exited(self, name):
+        role = self.roles[name]
+        now = time.monotonic()
+        uptime = now - role["started"]
+        if uptime >= self.stable_after:
+            role["failures"] = 0
+        if role["failures"]:
+            delay = min(
+                self.min_backoff * 2 ** (role["failures"] - 1),
+                self.max_backoff,
+            )
+        else:
+            delay = 0
+        role["failures"] += 1
+        role["restarts"] += 1
+        role["restart_at"] = now + delay
+        self.log(
+            "%s exited with %s after %.1fs, restarting in %.1fs",
+            name,
+            role["proc"].exitcode,
+            uptime,
+            delay,
+        )
+        role["proc"] = None
+        self.log_status()
+
+    def status(self):
+        """Return ``{name: (pid, restarts, uptime)}`` for every role; pid and
+        uptime are None while a role is waiting to be restarted"""
+        now = time.monotonic()
+        status = {}
+        for name, role in self.roles.items():
+            if role["proc"] is None:
+                status[name] = (None, role["restarts"], None)
+            else:
+                uptime = now - role["started"]
+                status[name] = (role["proc"].pid, role["restarts"], uptime)
+        return status
+
+    def log_status(self):
+        for name, (pid, restarts, uptime) in self.status().items():
+            if pid is None:
+                self.log("%s down, restarts %s", name, restarts)
+            else:
+                self.log(
+                    "%s pid %s up %.1fs, restarts %s",
+                    name,
+                    pid,
+                    uptime,
+                    restarts,
+                )
+
+    def run(self):
+        # a signal handler can't safely log (the handler may have
+        # interrupted a log call), so SIGHUP just wakes the loop below
+        hup_reader, hup_writer = os.pipe()
+        os.set_blocking(hup_writer, False)
+
+        def hup(signum, frame):
+            try:
+                os.write(hup_writer, b"x")
+            except BlockingIOError:
+                pass
+
+        signal.signal(signal.SIGHUP, hup)
+        try:
+            while True:
+                now = time.monotonic()
+                sentinels = {}
+                pending = []
+                for name, role in self.roles.items():
+                    if role["proc"] is not None:
+                        sentinels[role["proc"].sentinel] = name
+                    elif role["restart_at"] <= now:
+                        self.start(name)
+                        sentinels[role["proc"].sentinel] = name
+                    else:
+                        pending.append(role["restart_at"])
+                timeout = min(pending) - now if pending else None
+                ready = multiprocessing.connection.wait(
+                    list(sentinels) + [hup_reader], timeout
+                )
+                for sentinel in ready:
+                    if sentinel == hup_reader:
+                        os.read(hup_reader, 512)
+                        self.log_status()
+                    else:
+                        self.roles[sentinels[sentinel]]["proc"].join()
+                        self.exited(sentinels[sentinel])
+        finally:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            procs = [
+                role["proc"]
+                for role in self.roles.values()
+                if role["proc"] is not None
+            ]
+            for proc in procs:
+                proc.kill()
+            for proc in procs:
+                proc.join()
+            os.close(hup_reader)
+            os.close(hup_writer)
+
+
 def run_doorclient(
     server,
     secret,
@@ -569,6 +887,8 @@ def run_doorclient(
     unlock_gpio_pins,
     door_unlocked_duration,
     clientidentity,
+    doors,
+    codec,
     callbutton_gpio_pin,
     callbutton_bouncetime,
     pjsua_bin,
@@ -576,55 +896,42 @@ def run_doorclient(
     paging_sip,
     page_throttle_duration,
     reyax_config,
+    pjsua_standby_config_file=None,
 ):
-    procs = []
-
-    unlock_listener = Process(
-        name="unlock_listener",
-        daemon=True,
-        target=UnlockListener(
-            unlock_queue,
-            relock_queue,
-            broadcast_queue,
-            server,
-            secret,
-            clientidentity,
-            logger,
-        ).run,
+    supervisor = Supervisor(logger)
+
+    unlock_listener = UnlockListener(
+        unlock_queue,
+        relock_queue,
+        broadcast_queue,
+        server,
+        secret,
+        clientidentity,
+        doors,
+        codec,
+        logger,
     )
-    procs.append(unlock_listener)
-
-    unlock_executor = Process(
-        name="unlock_executor",
-        daemon=True,
-        target=UnlockExecutor(
-            unlock_queue,
-            relock_queue,
-            reyax_queue,
-            unlock_gpio_pins,
-            door_unlocked_duration,
-            logger,
-        ).run,
+    supervisor.add("unlock_listener", unlock_listener.run)
+
+    unlock_executor = UnlockExecutor(
+        unlock_queue,
+        relock_queue,
+        reyax_queue,
+        unlock_gpio_pins,
+        door_unlocked_duration,
+        logger,
     )
-    procs.append(unlock_executor)
+    supervisor.add("unlock_executor", unlock_executor.run)
 
-    page_listener = Process(
-        name="page_listener",
-        daemon=True,
-        target=PageListener(
+    if not os.environ.get("DOORSERVER_NOPAGE"):
+        page_listener = PageListener(
             page_queue,
             callbutton_gpio_pin,
             callbutton_bouncetime,
             logger,
-        ).run,
-    )
-    if not os.environ.get("DOORSERVER_NOPAGE"):
-        procs.append(page_listener)
-
-    page_executor = Process(
-        name="page_executor",
-        daemon=True,
-        target=PageExecutor(
+        )
+        supervisor.add("page_listener", page_listener.run)
+        page_executor = PageExecutor(
             page_queue,
             broadcast_queue,
             pjsua_bin,
@@ -632,52 +939,171 @@ def run_doorclient(
             paging_sip,
             page_throttle_duration,
             logger,
-        ).run,
-    )
-    if not os.environ.get("DOORSERVER_NOPAGE"):
-        procs.append(page_executor)
+            pjsua_standby_config_file,
+        )
+        supervisor.add("page_executor", page_executor.run)
 
-    for pin in unlock_gpio_pins:
+    for pin in unlock_gpio_pins.values():
         if pin.startswith("reyax:"):
-            reyax_handler = Process(
-                name="reyax_handler",
-                daemon=True,
-                target=ReyaxTransmissionHandler(
-                    door_unlocked_duration,
-                    reyax_config,
-                    reyax_queue,
-                    logger,
-                ).run,
+            reyax_handler = ReyaxTransmissionHandler(
+                door_unlocked_duration,
+                reyax_config,
+                reyax_queue,
+                logger,
             )
-            procs.append(reyax_handler)
+            supervisor.add("reyax_handler", reyax_handler.run)
             break
 
-    for proc in procs:
-        proc.start()
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+
 
+async def keep_serving(
+    name, serve, logger, min_backoff=0.1, max_backoff=30, stable_after=60
+):
+    """Await ``serve()`` over and over, the way Supervisor restarts a role's
+    process: if the role fails, the error is logged and it is started again,
+    with the same backoff, while the other roles carry on"""
+    failures = 0
+    while True:
+        started = time.monotonic()
+        try:
+            await serve()
+        except Exception:
+            logger.exception("SUPRV %s failed", name)
+        uptime = time.monotonic() - started
+        if uptime >= stable_after:
+            failures = 0
+        if failures:
+            delay = min(min_backoff * 2 ** (failures - 1), max_backoff)
+        else:
+            delay = 0
+        failures += 1
+        logger.info(
+            "SUPRV %s exited after %.1fs, restarting in %.1fs",
+            name,
+            uptime,
+            delay,
+        )
+        await asyncio.sleep(delay)
+
+
+def run_doorclient_asyncio(**kw):
+    """Run every role in this one process, on one event loop, rather than
+    one process each (``runtime = asyncio`` in client.ini): one Python
+    interpreter's worth of memory instead of up to six"""
     try:
-        while True:
-            for subproc in procs:
-                if not subproc.is_alive():
-                    raise AssertionError(f"subprocess {subproc} died")
-                time.sleep(1)
+        asyncio.run(serve_doorclient(**kw))
     except KeyboardInterrupt:
         pass
-    finally:
-        for subproc in procs:
-            if subproc.is_alive():
-                subproc.kill()
+
+
+async def serve_doorclient(
+    server,
+    secret,
+    logger,
+    unlock_gpio_pins,
+    door_unlocked_duration,
+    clientidentity,
+    doors,
+    codec,
+    callbutton_gpio_pin,
+    callbutton_bouncetime,
+    pjsua_bin,
+    pjsua_config_file,
+    paging_sip,
+    page_throttle_duration,
+    reyax_config,
+    pjsua_standby_config_file=None,
+):
+    unlock_queue = LocalQueue()
+    relock_queue = LocalQueue()
+    page_queue = LocalQueue()
+    broadcast_queue = LocalQueue()
+    reyax_queue = LocalQueue()
+
+    roles = []
+    unlock_listener = UnlockListener(
+        unlock_queue,
+        relock_queue,
+        broadcast_queue,
+        server,
+        secret,
+        clientidentity,
+        doors,
+        codec,
+        logger,
+    )
+    roles.append(("unlock_listener", unlock_listener.serve_forever))
+
+    unlock_executor = UnlockExecutor(
+        unlock_queue,
+        relock_queue,
+        reyax_queue,
+        unlock_gpio_pins,
+        door_unlocked_duration,
+        logger,
+    )
+    roles.append(("unlock_executor", unlock_executor.serve))
+
+    if not os.environ.get("DOORSERVER_NOPAGE"):
+        page_listener = PageListener(
+            page_queue,
+            callbutton_gpio_pin,
+            callbutton_bouncetime,
+            logger,
+        )
+        page_listener.setup()
+        page_executor = PageExecutor(
+            page_queue,
+            broadcast_queue,
+            pjsua_bin,
+            pjsua_config_file,
+            paging_sip,
+            page_throttle_duration,
+            logger,
+            pjsua_standby_config_file,
+        )
+        roles.append(("page_executor", page_executor.serve))
+
+    for pin in unlock_gpio_pins.values():
+        if pin.startswith("reyax:"):
+            reyax_handler = ReyaxTransmissionHandler(
+                door_unlocked_duration,
+                reyax_config,
+                reyax_queue,
+                logger,
+            )
+            roles.append(("reyax_handler", reyax_handler.serve))
+            break
+
+    # for testing, as below
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(
+        signal.SIGUSR1, lambda: unlock_queue.put((time.time(), 0, None))
+    )
+    loop.add_signal_handler(
+        signal.SIGUSR2, lambda: unlock_queue.put((time.time(), 1, None))
+    )
+    loop.add_signal_handler(signal.SIGALRM, lambda: page_queue.put(time.time()))
+
+    # a role that fails is restarted on its own, as when a subprocess dies
+    await asyncio.gather(
+        *(keep_serving(name, serve, logger) for name, serve in roles)
+    )
 
 
 # for testing
 def enqueue_unlock_front(*arg):
     now = time.time()
-    unlock_queue.put((now, 0))
+    unlock_queue.put((now, 0, None))
 
 
 def enqueue_unlock_inner(*arg):
     now = time.time()
-    unlock_queue.put((now, 1))
+    unlock_queue.put((now, 1, None))
 
 
 def enqueue_page(*arg):
@@ -722,20 +1148,36 @@ def main():
     if pjsua_config_file is None:
         raise AssertionError("pjsua_config_file must be supplied")
     args["pjsua_config_file"] = pjsua_config_file
+    # a second SIP account, registered by a pjsua kept ready to take over
+    args["pjsua_standby_config_file"] = section.get("pjsua_standby_config_file")
     args["paging_sip"] = section.get("paging_sip", "sip:7000@127.0.0.1:5065")
     loglevel = section.get("loglevel", "INFO")
     logfile = section.get("logfile")
-    logger = teelogger(logfile, loglevel)
+    logger = teelogger(
+        logfile,
+        loglevel,
+        max_bytes=int(section.get("logfile_max_bytes", log_max_bytes)),
+        backups=int(section.get("logfile_backups", log_backups)),
+        when=section.get("logfile_when"),
+    )
     args["logger"] = logger
-    unlock_gpio_pins = args["unlock_gpio_pins"] = []
-    default_pins = ["26", "24", "13"]
-    for x in range(0, 3):
-        val = section.get(f"unlock{x}_gpio_pin", default_pins[x])
-        unlock_gpio_pins.append(val)
+    # door numbers are the line indexes of the doorserver's doors file; a
+    # doorclient only claims the doors it has unlock pins for
+    doors = args["doors"] = [
+        int(x) for x in section.get("doors", "0,1,2").split(",")
+    ]
+    unlock_gpio_pins = args["unlock_gpio_pins"] = {}
+    default_pins = {0: "26", 1: "24", 2: "13"}
+    for x in doors:
+        val = section.get(f"unlock{x}_gpio_pin", default_pins.get(x))
+        if val is None:
+            raise AssertionError(f"unlock{x}_gpio_pin must be supplied")
+        unlock_gpio_pins[x] = val
     args["door_unlocked_duration"] = int(
         section.get("door_unlocked_duration", 5)
     )
     args["clientidentity"] = section.get("clientidentity", "doorclient")
+    args["codec"] = section.get("codec", "json")
     args["callbutton_gpio_pin"] = int(section.get("callbutton_gpio_pin", 16))
     args["callbutton_bouncetime"] = int(section.get("callbutton_bouncetime", 2))
     args["page_throttle_duration"] = int(
@@ -748,5 +1190,11 @@ def main():
     reyax["baudrate"] = int(section.get("reyax_baudrate", 115200))
     reyax["tty"] = section.get("reyax_tty", "/dev/ttyUSB0")
     reyax["unlock_msg"] = section.get("reyax_unlock_msg", "UNLOCK")
-    logger.info(f"MAIN pid is {os.getpid()}")
-    run_doorclient(**args)
+    runtime = section.get("runtime", "processes")
+    logger.info("MAIN pid is %s", os.getpid())
+    if runtime == "asyncio":
+        run_doorclient_asyncio(**args)
+    elif runtime == "processes":
+        run_doorclient(**args)
+    else:
+        raise AssertionError("runtime must be processes or asyncio")
@@ -1,153 +1,845 @@
 import argparse
 import asyncio
 import configparser
+import itertools
 import json
+import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import pprint
+import shutil
+import signal
 import sys
+import tempfile
 import time
 import uuid
 import websockets
 import websockets.exceptions
 
-from breakonthru.authentication import parse_passwords, make_token
-from breakonthru.util import teelogger
+from collections import Counter, OrderedDict, deque
+
+from breakonthru.authentication import (
+    TokenVerifier,
+    parse_passwords,
+    token_grace_secs,
+)
+from breakonthru.codec import default_codec, get_codec
+from breakonthru.util import log_backups, log_max_bytes, teelogger
+
+
+class ExpiringMap:
+    """A mapping whose entries expire ``lifetime`` seconds after they are
+    added and which holds at most ``maxsize`` entries, evicting the oldest
+    when full.
+
+    Every entry shares the same lifetime, so insertion order is expiry order:
+    expiring is popping from the front, and one timer, set for the oldest
+    entry's deadline, is all that has to be scheduled.  Evictions are counted
+    in ``metrics`` as ``<name>_expired``, ``<name>_evicted_full`` and
+    ``<name>_evicted_<reason>``."""
+
+    def __init__(self, name, lifetime, maxsize, metrics, logger):
+        self.name = name
+        self.lifetime = lifetime
+        self.maxsize = maxsize
+        self.metrics = metrics
+        self.logger = logger
+        self.entries = OrderedDict()  # key -> (deadline, value)
+        self.timer = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.lifetime, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.metrics[f"{self.name}_evicted_full"] += 1
+        self.schedule()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def items(self):
+        return [(key, value) for key, (deadline, value) in self.entries.items()]
+
+    def evict(self, predicate, reason):
+        """Remove every entry whose value satisfies ``predicate``"""
+        for key, value in self.items():
+            if predicate(value):
+                del self.entries[key]
+                self.metrics[f"{self.name}_evicted_{reason}"] += 1
+
+    def expire(self):
+        self.timer = None
+        now = time.monotonic()
+        expired = 0
+        while self.entries:
+            key, (deadline, value) = next(iter(self.entries.items()))
+            if deadline > now:
+                break
+            del self.entries[key]
+            expired += 1
+        if expired:
+            self.metrics[f"{self.name}_expired"] += expired
+            self.logger.info("expired %s %s", expired, self.name)
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is None and self.entries:
+            deadline = next(iter(self.entries.values()))[0]
+            delay = max(deadline - time.monotonic(), 0)
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(delay, self.expire)
+
+
+class Broadcast:
+    """A broadcast message, encoded at most once per codec"""
+
+    def __init__(self, when, message):
+        self.when = when
+        self.message = message
+        self.frames = {}
+
+    def frame(self, codec):
+        frame = self.frames.get(codec.name)
+        if frame is None:
+            frame = self.frames[codec.name] = codec.encode(self.message)
+        return frame
+
+
+class BroadcastRing:
+    """A fixed-size ring buffer of broadcasts.
+
+    Each broadcast gets the next sequence number; readers remember the last
+    sequence number they have seen and ask for what came after it.  Once the
+    ring wraps, the oldest broadcasts are overwritten, so memory use does not
+    depend on uptime or on the number of readers."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = [None] * size
+        self.seq = 0  # sequence number of the newest broadcast
+
+    def append(self, broadcast):
+        self.seq += 1
+        self.entries[self.seq % self.size] = broadcast
+        return self.seq
+
+    def since(self, cursor):
+        """Yield ``(seq, broadcast)`` for each broadcast newer than
+        ``cursor``, oldest first.  Broadcasts that have already been
+        overwritten are skipped."""
+        first = max(cursor + 1, self.seq - self.size + 1, 1)
+        for seq in range(first, self.seq + 1):
+            yield seq, self.entries[seq % self.size]
+
+    def cursor_at(self, cutoff):
+        """Return the cursor of a reader that has seen every broadcast made
+        at or before ``cutoff``"""
+        first = max(self.seq - self.size + 1, 1)
+        seq = self.seq
+        while seq >= first and self.entries[seq % self.size].when > cutoff:
+            seq -= 1
+        return seq
+
+
+class Connection:
+    """A websocket connected to the doorserver.
+
+    Messages addressed to this websocket are encoded with the codec it
+    identified with and go into ``outbox``; a single writer task per
+    connection drains it, so producers never wait on the network and frames
+    for a given websocket are written in the order they were produced.
+    Webclients also read broadcasts from the doorserver's broadcast ring,
+    keeping only the sequence number of the last one they were sent."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.wsid = websocket.id
+        self.identification = None  # identification is per-connection
+        self.clientidentity = None  # doorclients only
+        self.doors = ()  # doorclients only
+        self.codec = default_codec
+        self.outbox = deque()
+        self.broadcasts = None  # webclients only
+        self.cursor = 0
+        self.wakeup = asyncio.Event()
+        self.busy = False
+
+    def send(self, message):
+        self.send_frame(self.codec.encode(message))
+
+    def send_frame(self, frame):
+        self.outbox.append(frame)
+        self.wakeup.set()
+
+    def subscribe(self, broadcasts, cursor):
+        self.broadcasts = broadcasts
+        self.cursor = cursor
+        self.wakeup.set()
+
+    def idle(self):
+        """True if nothing is queued for or being written by the writer"""
+        return not (self.busy or self.outbox)
+
+    async def writer(self):
+        websocket = self.websocket
+        outbox = self.outbox
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                self.busy = True
+                while outbox:
+                    frame = outbox.popleft()
+                    await websocket.send(frame, text=self.codec.text)
+                if self.broadcasts is not None:
+                    for seq, broadcast in self.broadcasts.since(self.cursor):
+                        self.cursor = seq
+                        frame = broadcast.frame(self.codec)
+                        await websocket.send(frame, text=self.codec.text)
+                self.busy = False
+        except websockets.exceptions.ConnectionClosed:
+            return
+
+
+class LocalConnection:
+    """A webclient connection from code running in the doorserver's own
+    process (the webapp, when served by ``lockit-server``).  Messages to it
+    are handed to ``receive`` as they are, on the event loop, instead of
+    being encoded and written to a websocket.  It is identified from the
+    start and, like the webapp's websocket connections, gets no
+    broadcasts."""
+
+    def __init__(self, receive):
+        self.receive = receive
+        self.wsid = uuid.uuid4()
+        self.identification = "webclient"
+        self.clientidentity = None
+        self.codec = default_codec
+        self.broadcasts = None
+
+    def send(self, message):
+        self.receive(message)
+
+    def send_frame(self, frame):
+        self.receive(self.codec.decode(frame))
+
+
+class Broker:
+    """Relays shared state between doorserver workers.
+
+    Workers connect over a Unix domain socket, say which worker they are, and
+    then exchange newline-delimited JSON events.  An event with a ``to`` key
+    is passed only to that worker; any other event is passed to every other
+    worker.  The latest ``doorclient`` event for each clientidentity is kept
+    and replayed to each worker as it connects, so a restarted worker learns
+    where every doorclient is."""
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.workers = {}  # worker number -> StreamWriter
+        self.doorclients = {}  # clientidentity -> latest doorclient event
+
+    def log(self, msg, *args):
+        self.logger.info("BROKER " + msg, *args)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_unix_server(self.handler, self.path)
+        os.chmod(self.path, 0o600)  # events carry the secret
+        async with server:
+            await server.serve_forever()
+
+    def relay(self, event, line, sender):
+        to = event.get("to")
+        if to is not None:
+            targets = [self.workers.get(to)]
+        else:
+            targets = [w for n, w in self.workers.items() if n != sender]
+        for target in targets:
+            if target is not None:
+                target.write(line)
+
+    async def handler(self, reader, writer):
+        hello = json.loads(await reader.readline())
+        worker = hello["worker"]
+        self.log("worker %s connected", worker)
+        self.workers[worker] = writer
+        for event in self.doorclients.values():
+            writer.write(json.dumps(event).encode("utf-8") + b"\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                if event["event"] == "doorclient":
+                    self.doorclients[event["clientidentity"]] = event
+                self.relay(event, line, worker)
+        finally:
+            self.log("worker %s disconnected", worker)
+            if self.workers.get(worker) is writer:
+                del self.workers[worker]
+            # its doorclients went with it
+            for clientidentity, event in list(self.doorclients.items()):
+                if event["worker"] == worker and event["connected"]:
+                    event = dict(event, connected=False)
+                    self.doorclients[clientidentity] = event
+                    line = json.dumps(event).encode("utf-8") + b"\n"
+                    self.relay(event, line, worker)
+            writer.close()
 
 
 class Doorserver:
-    unlockdata = None
+    # webclients are sent broadcasts younger than this when they identify
+    broadcast_lifetime = 30
+    broadcast_ring_size = 64
+    # doors not claimed by any doorclient are routed to this clientidentity
+    default_doorclient = "doorclient"
+    # unlock requests held for a disconnected doorclient older than this are
+    # dropped rather than opening a door long after it was asked for
+    held_unlock_lifetime = 30
+    held_unlock_limit = 256
+    # unlocks a doorclient never sends a final ack for are forgotten after
+    # this long
+    pending_ack_lifetime = 120
+    pending_ack_limit = 1024
+    worker = None  # worker number when running more than one worker
+    broker_path = None
 
-    def __init__(self, secret, password_file, doors_file, port, logger):
+    def __init__(
+        self,
+        secret,
+        password_file,
+        doors_file,
+        port,
+        logger,
+        token_grace_secs=token_grace_secs,
+    ):
         self.secret = secret
+        self.password_file = password_file
+        # called with the new passwords after they are reloaded
+        self.reload_hooks = []
         with open(password_file, "r") as f:
             passwords = f.read()
         self.passwords = parse_passwords(passwords)
+        self.token_verifier = TokenVerifier(
+            secret, self.passwords, grace_secs=token_grace_secs
+        )
         self.logger = logger
-        self.acks = {}
-        self.pending_acks = {}
-        self.broadcasts = []
+        self.metrics = Counter()
+        self.connections = {}
+        self.doorclients = {}  # clientidentity -> Connection
+        self.door_owners = {}  # doornum -> clientidentity
+        # unlock requests made while the owning doorclient is not connected,
+        # in the order they were made, as (clientidentity, doornum,
+        # unlockdata); requests for doors no doorclient has claimed yet are
+        # held with a clientidentity of None
+        self.held_unlocks = ExpiringMap(
+            "held_unlocks",
+            self.held_unlock_lifetime,
+            self.held_unlock_limit,
+            self.metrics,
+            logger,
+        )
+        self.held_ids = itertools.count()
+        # msgid -> wsid of the webclient that asked for the unlock
+        self.pending_acks = ExpiringMap(
+            "pending_acks",
+            self.pending_ack_lifetime,
+            self.pending_ack_limit,
+            self.metrics,
+            logger,
+        )
+        # with several workers: msgid -> worker whose webclient asked for an
+        # unlock we passed to one of our doorclients
+        self.remote_acks = ExpiringMap(
+            "remote_acks",
+            self.pending_ack_lifetime,
+            self.pending_ack_limit,
+            self.metrics,
+            logger,
+        )
+        self.remote_doorclients = {}  # clientidentity -> worker
+        self.broker = None
+        self.broadcasts = BroadcastRing(self.broadcast_ring_size)
         self.port = port
+        self.loop = None  # the event loop, once serving
 
-    def log(self, msg):
-        self.logger.info(msg)
+    def log(self, msg, *args):
+        """Log ``msg % args``; the formatting is done only if INFO is
+        enabled"""
+        if self.worker is not None:
+            self.logger.info("WORKER%s " + msg, self.worker, *args)
+        else:
+            self.logger.info(msg, *args)
 
     def run(self):
         asyncio.run(self.serve())
 
+    def reload_passwords(self):
+        try:
+            with open(self.password_file, "r") as f:
+                passwords = parse_passwords(f.read())
+        except OSError as e:
+            self.log("could not reload passwords: %s", e)
+            return
+        self.passwords = passwords
+        self.token_verifier.reload(passwords)
+        for hook in self.reload_hooks:
+            hook(passwords)
+        self.log("reloaded passwords for %s users", len(passwords))
+
     async def serve(self):
-        async with websockets.serve(self.handler, "", self.port):
+        loop = self.loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, self.reload_passwords)
+        reuse_port = self.broker_path is not None
+        if reuse_port:
+            asyncio.create_task(self.connect_broker())
+        async with websockets.serve(
+            self.handler, "", self.port, reuse_port=reuse_port
+        ):
             await asyncio.Future()  # run forever
 
-    async def handler(self, websocket):
-        self.log("handler kicked off with websocket %s" % websocket)
-        wsid = websocket.id
-        identification = None  # identification is per-connection
+    def run_worker(self, worker, broker_path):
+        self.worker = worker
+        self.broker_path = broker_path
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            pass
+
+    def run_workers(self, count):
+        """Run ``count`` worker processes sharing the listening port, plus a
+        broker process they share state through, restarting any of them
+        that exits."""
+        tmpdir = tempfile.mkdtemp(prefix="doorserver-")
+        broker_path = os.path.join(tmpdir, "broker.sock")
+        broker = Broker(broker_path, self.logger)
+        targets = {"broker": (broker.run, ())}
+        for worker in range(count):
+            targets[f"worker{worker}"] = (
+                self.run_worker,
+                (worker, broker_path),
+            )
+        procs = {}
+
+        def reload(signum, frame):
+            for name, proc in procs.values():
+                if name != "broker":
+                    os.kill(proc.pid, signal.SIGHUP)
+
+        def start(name):
+            target, args = targets[name]
+            proc = multiprocessing.Process(
+                name=name, target=target, args=args, daemon=True
+            )
+            proc.start()
+            procs[proc.sentinel] = (name, proc)
+            self.log("started %s pid %s", name, proc.pid)
+
+        signal.signal(signal.SIGHUP, reload)
+        try:
+            start("broker")
+            for name in targets:
+                if name != "broker":
+                    start(name)
+            while True:
+                for sentinel in multiprocessing.connection.wait(list(procs)):
+                    name, proc = procs.pop(sentinel)
+                    self.log(
+                        "%s exited with %s, restarting", name, proc.exitcode
+                    )
+                    if name == "broker" and os.path.exists(broker_path):
+                        os.unlink(broker_path)
+                    start(name)
+        finally:
+            for name, proc in procs.values():
+                proc.kill()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    async def connect_broker(self):
+        delay = 0.05
         while True:
             try:
-                message = await asyncio.wait_for(websocket.recv(), timeout=0.25)
-            except (
-                websockets.ConnectionClosedOK,
-                websockets.exceptions.ConnectionClosedError,
-            ):
-                break
-            except asyncio.TimeoutError:
-                now = time.time()
-                for (i, broadcast) in enumerate(self.broadcasts[:]):
-                    if now - broadcast["when"] > 30:
-                        del self.broadcasts[i]
-                if identification == "doorclient":
-                    if self.unlockdata is not None:
-                        self.log("sending unlock request")
-                        await websocket.send(self.unlockdata)
-                        self.log("sent unlock request")
-                        self.unlockdata = None
-                if identification == "webclient":
-                    acklist = self.acks.pop(wsid, [])
-                    for ack in acklist:
-                        await websocket.send(ack)
-                    for broadcast in self.broadcasts:
-                        wids = broadcast["wids"]
-                        if wsid not in wids:
-                            await websocket.send(
-                                json.dumps(broadcast["message"])
-                            )
-                            wids.append(wsid)
-
+                reader, writer = await asyncio.open_unix_connection(
+                    self.broker_path
+                )
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2)
                 continue
+            delay = 0.05
+            self.log("connected to broker")
+            self.broker = writer
+            self.share({"event": "hello", "worker": self.worker})
+            for clientidentity, connection in self.doorclients.items():
+                self.share_doorclient(clientidentity, connection.doors, True)
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.receive_shared(json.loads(line))
+            except ConnectionError:
+                pass
+            self.broker = None
+            # the broker replays these when we reconnect
+            self.remote_doorclients.clear()
+            writer.close()
+            self.log("lost broker connection")
+
+    def share(self, event):
+        """Pass ``event`` to the other workers, if there are any"""
+        if self.broker is not None:
+            self.broker.write(json.dumps(event).encode("utf-8") + b"\n")
+
+    def share_doorclient(self, clientidentity, doors, connected):
+        self.share(
+            {
+                "event": "doorclient",
+                "clientidentity": clientidentity,
+                "doors": list(doors),
+                "worker": self.worker,
+                "connected": connected,
+            }
+        )
 
-            message = json.loads(message)
-            msgtype = message.get("type")
+    def receive_shared(self, event):
+        kind = event["event"]
+        if kind == "doorclient":
+            clientidentity = event["clientidentity"]
+            worker = event["worker"]
+            if event["connected"]:
+                for doornum in event["doors"]:
+                    self.door_owners[int(doornum)] = clientidentity
+                if clientidentity not in self.doorclients:
+                    self.remote_doorclients[clientidentity] = worker
+                    for unlockdata in self.take_held(clientidentity):
+                        self.forward_unlock(worker, unlockdata)
+            elif self.remote_doorclients.get(clientidentity) == worker:
+                del self.remote_doorclients[clientidentity]
+        if kind == "unlock":
+            unlockdata = event["unlockdata"]
+            self.remote_acks.add(unlockdata["msgid"], event["origin"])
+            clientidentity = event["clientidentity"]
+            doorclient = self.doorclients.get(clientidentity)
+            if doorclient is not None:
+                doorclient.send(unlockdata)
+            else:
+                # it left; passed on again when it shows up somewhere
+                doornum = int(unlockdata["doornum"])
+                self.hold_unlock(clientidentity, doornum, unlockdata)
+        if kind == "ack":
+            self.deliver_ack(event["message"])
+        if kind == "broadcast":
+            self.publish(event["message"])
 
-            if msgtype == "identification":
-                ident = message["body"]
-                if ident == "doorclient":
-                    clientprovidedsecret = message.get("secret")
-                    if clientprovidedsecret == self.secret:
-                        identification = ident
-                        self.log("identification is %s" % ident)
+    async def handler(self, websocket):
+        self.log("handler kicked off with websocket %s", websocket)
+        connection = Connection(websocket)
+        self.connections[connection.wsid] = connection
+        writer = asyncio.create_task(connection.writer())
+        try:
+            async for message in websocket:
+                self.receive(connection, message)
+        except websockets.exceptions.ConnectionClosedError:
+            pass
+        finally:
+            writer.cancel()
+            wsid = connection.wsid
+            self.connections.pop(wsid, None)
+            if connection.identification == "webclient":
+                # nobody is left to deliver these acks to
+                self.pending_acks.evict(lambda v: v == wsid, "disconnect")
+            clientidentity = connection.clientidentity
+            if self.doorclients.get(clientidentity) is connection:
+                del self.doorclients[clientidentity]
+                self.share_doorclient(clientidentity, connection.doors, False)
+                # unlocks the writer did not get to go back in line; anything
+                # else (a metrics reply) was only for this connection
+                while connection.outbox:
+                    frame = connection.outbox.popleft()
+                    unlockdata = connection.codec.decode(frame)
+                    if unlockdata.get("type") != "unlock":
                         continue
-                    self.log("bad identification for %s" % ident)
-                if ident == "webclient":
-                    user = message["user"]
-                    token = message["token"]
-                    userdata = self.passwords.get(user)
-                    if userdata is not None:
-                        password = userdata.get("password")
-                        if password is not None:
-                            expectedtoken = make_token(self.secret, password)
-                            if expectedtoken == token:
-                                identification = ident
-                                self.log("identification is %s" % ident)
-                                continue
-                    self.log("bad identification for %s (%s)" % (ident, user))
-
-            if identification == "webclient":
-                if msgtype == "unlock":
+                    doornum = int(unlockdata["doornum"])
+                    self.hold_unlock(clientidentity, doornum, unlockdata)
+                self.log("doorclient %s disconnected", clientidentity)
+
+    def connect_local(self, receive):
+        """Return a webclient connection for code in this process, which is
+        passed each message sent to it by calling ``receive``.  Must be
+        called on the event loop."""
+        connection = LocalConnection(receive)
+        self.connections[connection.wsid] = connection
+        return connection
+
+    def connected(self, identification):
+        return [
+            connection
+            for connection in self.connections.values()
+            if connection.identification == identification
+        ]
+
+    def owner(self, doornum):
+        return self.door_owners.get(doornum, self.default_doorclient)
+
+    def hold_unlock(self, clientidentity, doornum, unlockdata):
+        self.held_unlocks.add(
+            next(self.held_ids), (clientidentity, doornum, unlockdata)
+        )
+
+    def take_held(self, clientidentity):
+        """Remove and return, oldest first, the held unlock requests that
+        belong to the doorclient ``clientidentity``"""
+        taken = []
+        for key, (heldfor, doornum, unlockdata) in self.held_unlocks.items():
+            if heldfor is None:
+                heldfor = self.owner(doornum)
+            if heldfor == clientidentity:
+                self.held_unlocks.pop(key)
+                taken.append(unlockdata)
+        return taken
+
+    def forward_unlock(self, worker, unlockdata):
+        clientidentity = self.owner(int(unlockdata["doornum"]))
+        self.log(
+            "passing unlock request to %s on worker %s", clientidentity, worker
+        )
+        self.metrics["unlocks_forwarded"] += 1
+        self.share(
+            {
+                "event": "unlock",
+                "to": worker,
+                "origin": self.worker,
+                "clientidentity": clientidentity,
+                "unlockdata": unlockdata,
+            }
+        )
+
+    def route_unlock(self, doornum, unlockdata):
+        clientidentity = self.owner(doornum)
+        doorclient = self.doorclients.get(clientidentity)
+        if doorclient is not None:
+            self.log("sending unlock request to %s", clientidentity)
+            doorclient.send(unlockdata)
+        elif clientidentity in self.remote_doorclients and self.broker:
+            worker = self.remote_doorclients[clientidentity]
+            self.forward_unlock(worker, unlockdata)
+        else:
+            self.log(
+                "doorclient %s not connected, holding unlock", clientidentity
+            )
+            if doornum not in self.door_owners:
+                clientidentity = None
+            self.hold_unlock(clientidentity, doornum, unlockdata)
+
+    def register_doorclient(self, connection, clientidentity, doors):
+        connection.identification = "doorclient"
+        connection.clientidentity = clientidentity
+        connection.doors = doors
+        self.doorclients[clientidentity] = connection
+        self.remote_doorclients.pop(clientidentity, None)
+        for doornum in doors:
+            self.door_owners[int(doornum)] = clientidentity
+        for unlockdata in self.take_held(clientidentity):
+            self.log("sending held unlock request to %s", clientidentity)
+            connection.send(unlockdata)
+        self.share_doorclient(clientidentity, doors, True)
+
+    def deliver_ack(self, message, frame=None, codec=None):
+        """Pass an ack from a doorclient to the webclient that asked for the
+        unlock, wherever it is connected.  ``frame`` is the ack as received,
+        encoded with ``codec``, and is forwarded as is when possible."""
+        msgid = message["msgid"]
+        if message.get("final"):
+            wsid = self.pending_acks.pop(msgid)
+        else:
+            wsid = self.pending_acks.get(msgid)
+        if wsid is None:
+            if message.get("final"):
+                worker = self.remote_acks.pop(msgid)
+            else:
+                worker = self.remote_acks.get(msgid)
+            if worker is not None:
+                self.metrics["acks_forwarded"] += 1
+                self.share({"event": "ack", "to": worker, "message": message})
+            return
+        webclient = self.connections.get(wsid)
+        if webclient is None:
+            pass
+        elif frame is not None and webclient.codec is codec:
+            # forwarded as received, no need to reencode
+            webclient.send_frame(frame)
+        else:
+            webclient.send(message)
+
+    def publish(self, message):
+        """Add a broadcast to the ring and fan it out to the webclients.
+
+        The frame is encoded once per codec in use.  Webclients that are
+        caught up and whose writer is idle get it right away through one
+        ``websockets.broadcast`` call per codec, which writes the same bytes
+        to each of them; the others are woken to read it from the ring."""
+        broadcast = Broadcast(time.time(), message)
+        seq = self.broadcasts.append(broadcast)
+        ready = {}
+        for webclient in self.connected("webclient"):
+            if webclient.broadcasts is None:
+                continue  # the webapp's connections
+            if webclient.cursor == seq - 1 and webclient.idle():
+                webclient.cursor = seq
+                recipients = ready.setdefault(webclient.codec, [])
+                recipients.append(webclient.websocket)
+            else:
+                webclient.wakeup.set()
+        for codec, recipients in ready.items():
+            frame = broadcast.frame(codec)
+            websockets.broadcast(recipients, frame, text=codec.text)
+
+    def receive(self, connection, frame):
+        if isinstance(frame, str):
+            # identification is always JSON text
+            message = json.loads(frame)
+        else:
+            message = connection.codec.decode(frame)
+        self.dispatch(connection, message, frame)
+
+    def dispatch(self, connection, message, frame=None):
+        """Act on ``message`` from ``connection``; ``frame`` is the message as
+        received, if it came over a websocket"""
+        wsid = connection.wsid
+        msgtype = message.get("type")
+
+        if msgtype == "identification":
+            ident = message["body"]
+            try:
+                codec = get_codec(message.get("codec"))
+            except ValueError as e:
+                self.log("bad identification for %s: %s", ident, e)
+                return
+            if ident != "webclient":
+                # doorclients identify using their clientidentity
+                clientprovidedsecret = message.get("secret")
+                if clientprovidedsecret == self.secret:
+                    doors = message.get("doors", ())
+                    self.log("identification is doorclient %s %s", ident, doors)
+                    connection.codec = codec
+                    self.register_doorclient(connection, ident, doors)
+                    return
+                self.log("bad identification for %s", ident)
+            if ident == "webclient":
+                if "secret" in message:
+                    # the webapp's own connections send unlocks on behalf of
+                    # users it has already authenticated; they don't want
+                    # broadcasts
+                    if message["secret"] == self.secret:
+                        connection.identification = ident
+                        connection.codec = codec
+                        self.log("identification is webclient (webapp)")
+                        return
+                    self.log("bad identification for webclient (webapp)")
+                    return
+                user = message["user"]
+                token = message["token"]
+                if self.token_verifier.verify(user, token):
+                    connection.identification = ident
+                    connection.codec = codec
+                    self.log("identification is %s", ident)
+                    cutoff = time.time() - self.broadcast_lifetime
+                    connection.subscribe(
+                        self.broadcasts,
+                        self.broadcasts.cursor_at(cutoff),
+                    )
+                    return
+                self.log("bad identification for %s (%s)", ident, user)
+
+        if connection.identification == "webclient":
+            if msgtype == "ping":
+                # browsers can't send websocket pings, so they send these to
+                # find out whether their connection is still alive
+                connection.send({"type": "pong"})
+            if msgtype == "unlock":
+                if self.logger.isEnabledFor(logging.INFO):
                     self.log(
-                        f"unlock request received from webclient {pprint.pformat(message)}"
+                        "unlock request received from webclient %s",
+                        pprint.pformat(message),
                     )
-                    # we must send the secret to the doorclient
-                    user = message["body"]
-                    msgid = uuid.uuid4().hex
-                    userdata = self.passwords.get(user)
-                    doornum = message["doornum"]
-                    if userdata is not None:
-                        if int(doornum) in userdata["doors"]:
-                            unlockdata = {
-                                "type": "unlock",
-                                "body": user,
-                                "doornum": doornum,
-                                "msgid": msgid,
-                                "secret": self.secret,
-                            }
-                            self.unlockdata = json.dumps(unlockdata)
-                            self.pending_acks[msgid] = wsid
-                        else:
-                            self.log(
-                                f"unauthorized doornum {doornum} unlock requested "
-                                f"by {user}"
+                # we must send the secret to the doorclient
+                user = message["body"]
+                msgid = uuid.uuid4().hex
+                userdata = self.passwords.get(user)
+                doornum = message["doornum"]
+                # clients that send a ref are told the msgid their acks
+                # will carry (or why there won't be any)
+                ref = message.get("ref")
+                if userdata is not None:
+                    if int(doornum) in userdata["doors"]:
+                        unlockdata = {
+                            "type": "unlock",
+                            "body": user,
+                            "doornum": doornum,
+                            "msgid": msgid,
+                            "secret": self.secret,
+                        }
+                        if ref is not None:
+                            connection.send(
+                                {
+                                    "type": "unlocking",
+                                    "ref": ref,
+                                    "msgid": msgid,
+                                }
                             )
-
-            if identification == "doorclient":
-                if msgtype == "ack":
-                    msgid = message["msgid"]
-                    final = message.get("final")
-                    if final:
-                        wsid = self.pending_acks.pop(msgid, None)
+                        self.pending_acks.add(msgid, wsid)
+                        self.metrics["unlocks"] += 1
+                        self.route_unlock(int(doornum), unlockdata)
+                        return
                     else:
-                        wsid = self.pending_acks.get(msgid, None)
-                    if wsid is not None:
-                        acklist = self.acks.setdefault(wsid, [])
-                        acklist.append(json.dumps(message))
-                if msgtype == "broadcast":
-                    self.broadcasts.append(
+                        self.log(
+                            "unauthorized doornum %s unlock requested by %s",
+                            doornum,
+                            user,
+                        )
+                if ref is not None:
+                    connection.send(
                         {
-                            "wids": [],
-                            "when": time.time(),
-                            "message": message,
+                            "type": "unlocking",
+                            "ref": ref,
+                            "error": "not allowed",
                         }
                     )
 
+        if connection.identification == "doorclient":
+            if msgtype == "ack":
+                self.metrics["acks"] += 1
+                self.deliver_ack(message, frame, connection.codec)
+            if msgtype == "broadcast":
+                self.metrics["broadcasts"] += 1
+                self.publish(message)
+                self.share({"event": "broadcast", "message": message})
+            if msgtype == "metrics":
+                connection.send({"type": "metrics", "body": dict(self.metrics)})
+
 
 def main():
     args = {}
@@ -192,13 +884,32 @@ def main():
             raise AssertionError("secret must be supplied")
     args["secret"] = secret
 
+    grace = os.environ.get("DOORSERVER_TOKEN_GRACE_SECS")
+    if grace is None:
+        grace = section.get("token_grace_secs", token_grace_secs)
+    args["token_grace_secs"] = int(grace)
+
+    workers = os.environ.get("DOORSERVER_WORKERS")
+    if workers is None:
+        workers = section.get("workers", 1)
+    workers = int(workers)
+
     loglevel = section.get("loglevel", "INFO")
     logfile = section.get("logfile")
-    logger = teelogger(logfile, loglevel)
+    logger = teelogger(
+        logfile,
+        loglevel,
+        max_bytes=int(section.get("logfile_max_bytes", log_max_bytes)),
+        backups=int(section.get("logfile_backups", log_backups)),
+        when=section.get("logfile_when"),
+    )
     args["logger"] = logger
-    logger.info(f"MAIN pid is {os.getpid()}")
+    logger.info("MAIN pid is %s", os.getpid())
     server = Doorserver(**args)
     try:
-        server.run()
+        if workers > 1:
+            server.run_workers(workers)
+        else:
+            server.run()
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,654 @@
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import timeit
+import uuid
+import websockets
+
+from breakonthru.authentication import make_token
+from breakonthru.codec import codecs
+from breakonthru.ipc import Queue
+from breakonthru.scripts.doorserver import Doorserver
+
+SECRET = "benchsecret"
+USER = "bench"
+# the doorserver only ever uses the stored hash as token material, so any
+# string will do here
+PASSWORD_HASH = "$2b$12$benchbenchbenchbenchbenchbenchbenchbenchbenchbenchbe"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    if len(samples) == 1:
+        p50 = p95 = p99 = samples[0]
+    else:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {"p50": p50, "p95": p95, "p99": p99, "max": samples[-1]}
+
+
+def format_ms(stats):
+    return " ".join(f"{k}={v * 1000:.2f}ms" for k, v in stats.items())
+
+
+async def serve_with_lag_probe(doorserver, lagpipe, interval=0.01):
+    """Run the doorserver while measuring how late its event loop wakes up
+    from a short sleep.  Whenever the parent writes to ``lagpipe`` the
+    samples so far are sent back and forgotten."""
+    loop = asyncio.get_running_loop()
+    lags = []
+
+    async def probe():
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - start - interval)
+
+    def report():
+        lagpipe.recv()
+        lagpipe.send(lags[:])
+        lags.clear()
+
+    loop.add_reader(lagpipe.fileno(), report)
+    asyncio.create_task(probe())
+    await doorserver.serve()
+
+
+# runs the doorserver of another revision, which can't be imported here
+# alongside this one's
+REV_SERVER = """
+import logging, sys
+from breakonthru.scripts.doorserver import Doorserver
+logger = logging.getLogger("doorserver-bench")
+logger.setLevel(logging.WARNING)
+secret, password_file, doors_file, port = sys.argv[1:]
+Doorserver(secret, password_file, doors_file, int(port), logger).run()
+"""
+
+
+def export_rev(rev, directory):
+    """Write the breakonthru package as of git revision ``rev`` (of the
+    checkout this module is in) to ``directory``"""
+    checkout = os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    tar = subprocess.run(
+        ["git", "-C", checkout, "archive", "--format=tar", rev, "breakonthru"],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(tar)) as f:
+        f.extractall(directory)
+
+
+def run_server(secret, password_file, doors_file, port, lagpipe):
+    logger = logging.getLogger("doorserver-bench")
+    logger.setLevel(logging.WARNING)
+    doorserver = Doorserver(secret, password_file, doors_file, port, logger)
+    if lagpipe is None:
+        doorserver.run()
+    else:
+        asyncio.run(serve_with_lag_probe(doorserver, lagpipe))
+
+
+class BenchServer:
+    """Run a doorserver in a child process against throwaway config; the
+    one in this tree, or, given ``rev``, the one at that git revision, so
+    the same benchmark can be run before and after a change"""
+
+    def __init__(self, doors=2, lag_probe=False, rev=None):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.password_file = os.path.join(self.tmpdir.name, "passwords")
+        self.doors_file = os.path.join(self.tmpdir.name, "doors")
+        with open(self.password_file, "w") as f:
+            f.write(f"{USER} = {PASSWORD_HASH}\n")
+        with open(self.doors_file, "w") as f:
+            for n in range(doors):
+                f.write(f"Door {n}\n")
+        self.port = free_port()
+        self.url = f"ws://127.0.0.1:{self.port}/"
+        self.lagpipe = childpipe = None
+        self.rev = rev
+        self.make_token = make_token
+        if rev is not None:
+            self.rev_path = os.path.join(self.tmpdir.name, "rev")
+            export_rev(rev, self.rev_path)
+            # tokens are made the way that revision checks them
+            spec = importlib.util.spec_from_file_location(
+                "rev_authentication",
+                os.path.join(self.rev_path, "breakonthru", "authentication.py"),
+            )
+            authentication = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(authentication)
+            self.make_token = authentication.make_token
+            # and it runs its own code, so can't have a lag probe
+            return
+        if lag_probe:
+            self.lagpipe, childpipe = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(
+            target=run_server,
+            args=(
+                SECRET,
+                self.password_file,
+                self.doors_file,
+                self.port,
+                childpipe,
+            ),
+            daemon=True,
+        )
+
+    def __enter__(self):
+        if self.rev is None:
+            self.proc.start()
+        else:
+            self.proc = subprocess.Popen(
+                [sys.executable, "-c", REV_SERVER, SECRET]
+                + [self.password_file, self.doors_file, str(self.port)],
+                # python -c puts its current directory first on the path,
+                # which mustn't be a checkout of this tree
+                cwd=self.rev_path,
+                env=dict(os.environ, PYTHONPATH=self.rev_path),
+            )
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:  # nobreak
+            raise AssertionError("doorserver did not start")
+        return self
+
+    def __exit__(self, *exc):
+        self.proc.kill()
+        if self.rev is None:
+            self.proc.join()
+        else:
+            self.proc.wait()
+        self.tmpdir.cleanup()
+
+    def token(self):
+        return self.make_token(SECRET, PASSWORD_HASH)
+
+    def cpu_seconds(self):
+        """User plus system CPU time consumed by the server so far"""
+        with open(f"/proc/{self.proc.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+    def rss_bytes(self):
+        with open(f"/proc/{self.proc.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+
+    def loop_lag(self):
+        """Event loop lag samples (seconds) since the last call; there are
+        none without ``lag_probe``, or when running another revision"""
+        if self.lagpipe is None:
+            return []
+        self.lagpipe.send(None)
+        return self.lagpipe.recv()
+
+
+async def webclient(url, token=None):
+    if token is None:
+        token = make_token(SECRET, PASSWORD_HASH)
+    websocket = await websockets.connect(url)
+    await websocket.send(
+        json.dumps(
+            {
+                "type": "identification",
+                "body": "webclient",
+                "user": USER,
+                "token": token,
+            }
+        )
+    )
+    return websocket
+
+
+async def identify_doorclient(websocket, clientidentity="doorclient", doors=()):
+    await websocket.send(
+        json.dumps(
+            {
+                "type": "identification",
+                "body": clientidentity,
+                "secret": SECRET,
+                "doors": list(doors),
+            }
+        )
+    )
+
+
+async def doorclient(
+    url, relock_delay=0, clientidentity="doorclient", doors=()
+):
+    """A fake doorclient which acks every unlock and relocks after
+    ``relock_delay`` seconds"""
+
+    async def relock(websocket, msgid, doornum):
+        await asyncio.sleep(relock_delay)
+        await websocket.send(
+            json.dumps(
+                {
+                    "type": "ack",
+                    "msgid": msgid,
+                    "final": True,
+                    "body": f"relocked door {doornum}",
+                }
+            )
+        )
+
+    relocks = set()
+    async with websockets.connect(url) as websocket:
+        await identify_doorclient(websocket, clientidentity, doors)
+        async for message in websocket:
+            message = json.loads(message)
+            if message.get("type") != "unlock":
+                continue
+            msgid = message["msgid"]
+            doornum = message["doornum"]
+            await websocket.send(
+                json.dumps(
+                    {
+                        "type": "ack",
+                        "msgid": msgid,
+                        "body": f"unlock request for door {doornum}",
+                    }
+                )
+            )
+            if relock_delay:
+                task = asyncio.create_task(relock(websocket, msgid, doornum))
+                relocks.add(task)
+                task.add_done_callback(relocks.discard)
+            else:
+                await relock(websocket, msgid, doornum)
+
+
+async def unlock_roundtrip(websocket, doornum=0):
+    """Send one unlock, return seconds until the first and the final ack"""
+    start = time.perf_counter()
+    await websocket.send(
+        json.dumps({"type": "unlock", "body": USER, "doornum": doornum})
+    )
+    first = None
+    while True:
+        message = json.loads(await websocket.recv())
+        if message.get("type") != "ack":
+            continue
+        if first is None:
+            first = time.perf_counter() - start
+        if message.get("final"):
+            return first, time.perf_counter() - start
+
+
+async def latency(server, args):
+    idle = [
+        await webclient(server.url, server.token())
+        for _ in range(args.idle_clients)
+    ]
+    await asyncio.sleep(1)  # let identification settle
+    before = server.cpu_seconds()
+    await asyncio.sleep(args.idle_seconds)
+    idle_cpu = server.cpu_seconds() - before
+    print(
+        f"idle: {args.idle_clients} webclients for {args.idle_seconds}s "
+        f"used {idle_cpu:.3f}s server CPU "
+        f"({100 * idle_cpu / args.idle_seconds:.2f}% of a core)"
+    )
+
+    door = asyncio.create_task(doorclient(server.url))
+    await asyncio.sleep(0.5)
+    websocket = await webclient(server.url, server.token())
+    firsts, finals = [], []
+    for _ in range(args.unlocks):
+        first, final = await unlock_roundtrip(websocket)
+        firsts.append(first)
+        finals.append(final)
+    print(f"unlock->first ack: {format_ms(percentiles(firsts))}")
+    print(f"unlock->final ack: {format_ms(percentiles(finals))}")
+
+    door.cancel()
+    for ws in idle + [websocket]:
+        await ws.close()
+
+
+async def fanout(server, args):
+    for round, count in enumerate(args.webclients):
+        clients = [
+            await webclient(server.url, server.token()) for _ in range(count)
+        ]
+        await asyncio.sleep(1)  # let identification settle
+        received = asyncio.Queue()
+
+        async def listen(websocket):
+            async for message in websocket:
+                now = time.perf_counter()
+                # newly identified webclients are also sent the previous
+                # round's broadcasts; skip those
+                if json.loads(message)["body"][0] == round:
+                    received.put_nowait(now)
+
+        listeners = [asyncio.create_task(listen(ws)) for ws in clients]
+        sender = await websockets.connect(server.url)
+        await identify_doorclient(sender)
+        await asyncio.sleep(0.5)
+
+        latencies = []
+        before = server.cpu_seconds()
+        for n in range(args.broadcasts):
+            start = time.perf_counter()
+            await sender.send(
+                json.dumps({"type": "broadcast", "body": [round, n]})
+            )
+            for _ in range(count):
+                last = await received.get()
+            latencies.append(last - start)
+        cpu = server.cpu_seconds() - before
+
+        print(
+            f"{count} webclients: "
+            f"server CPU {cpu / args.broadcasts * 1000:.3f}ms/broadcast, "
+            f"delivered to all: {format_ms(percentiles(latencies))}"
+        )
+        for listener in listeners:
+            listener.cancel()
+        for ws in clients + [sender]:
+            await ws.close()
+
+
+class RecordingBuzzer:
+    """Stands in for a door's GPIO pin, putting ``(state, time.monotonic())``
+    on ``queue`` whenever it is switched"""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def on(self):
+        self.queue.put(("on", time.monotonic()))
+
+    def off(self):
+        self.queue.put(("off", time.monotonic()))
+
+
+async def doorclient_latency(server, args):
+    # the doorclient needs gpiozero and friends, which nothing else here does
+    from breakonthru.scripts.doorclient import UnlockExecutor, UnlockListener
+
+    class Executor(UnlockExecutor):
+        def buzzer(self, pin):
+            return RecordingBuzzer(pins)
+
+    logger = logging.getLogger("doorserver-bench")
+    logger.setLevel(logging.WARNING)
+    unlock_queue, relock_queue, broadcast_queue, pins = (
+        Queue() for _ in range(4)
+    )
+    listener = UnlockListener(
+        unlock_queue,
+        relock_queue,
+        broadcast_queue,
+        server.url,
+        SECRET,
+        "doorclient",
+        [0, 1],
+        "json",
+        logger,
+    )
+    executor = Executor(
+        unlock_queue,
+        relock_queue,
+        None,
+        {0: "0", 1: "1"},
+        args.unlocked_duration,
+        logger,
+    )
+    procs = [
+        multiprocessing.Process(target=target.run, daemon=True)
+        for target in (listener, executor)
+    ]
+    for proc in procs:
+        proc.start()
+    await asyncio.sleep(1)  # let the doorclient connect
+    websocket = await webclient(server.url, server.token())
+    acks, ons, relocks = [], [], []
+    for _ in range(args.unlocks):
+        start = time.monotonic()
+        first, final = await unlock_roundtrip(websocket)
+        state, on = pins.get(timeout=5)
+        state, off = pins.get(timeout=5)
+        acks.append(first)
+        ons.append(on - start)
+        relocks.append(start + final - off)
+    print(f"unlock->ack:          {format_ms(percentiles(acks))}")
+    print(f"unlock->GPIO on:      {format_ms(percentiles(ons))}")
+    print(f"GPIO off->relock ack: {format_ms(percentiles(relocks))}")
+
+    # doors are held open concurrently, so unlocking two at once takes no
+    # longer than unlocking one
+    other = await webclient(server.url, server.token())
+    both = []
+    for _ in range(min(args.unlocks, 10)):
+        start = time.monotonic()
+        await asyncio.gather(
+            unlock_roundtrip(websocket, 0), unlock_roundtrip(other, 1)
+        )
+        both.append(time.monotonic() - start - args.unlocked_duration)
+        pins.drain()
+    print(
+        "2 doors->both relocked, less unlocked duration: "
+        f"{format_ms(percentiles(both))}"
+    )
+    await other.close()
+    await websocket.close()
+    for proc in procs:
+        proc.kill()
+
+
+async def codecbench(server, args):
+    msgid = uuid.uuid4().hex
+    shapes = {
+        "unlock": {
+            "type": "unlock",
+            "body": USER,
+            "doornum": 0,
+            "msgid": msgid,
+            "secret": SECRET,
+        },
+        "ack": {
+            "type": "ack",
+            "msgid": msgid,
+            "final": True,
+            "body": "relocked door 0",
+        },
+        "broadcast": {
+            "type": "broadcast",
+            "body": "SIP: paging all connected handsets",
+        },
+    }
+    for codec in codecs.values():
+        for shape, message in shapes.items():
+            frame = codec.encode(message)
+            encode = min(
+                timeit.repeat(
+                    lambda: codec.encode(message), number=args.number, repeat=5
+                )
+            )
+            decode = min(
+                timeit.repeat(
+                    lambda: codec.decode(frame), number=args.number, repeat=5
+                )
+            )
+            print(
+                f"{codec.name:8} {shape:10} {len(frame):4} bytes  "
+                f"encode {encode / args.number * 1e6:.2f}us  "
+                f"decode {decode / args.number * 1e6:.2f}us"
+            )
+
+
+async def load(server, args):
+    rss_before = server.rss_bytes()
+    doorclients = [
+        asyncio.create_task(
+            doorclient(server.url, args.relock_delay, f"doorclient{n}", [n])
+        )
+        for n in range(args.doorclients)
+    ]
+    webclients = [
+        await webclient(server.url, server.token())
+        for _ in range(args.webclients)
+    ]
+    await asyncio.sleep(1)  # let identification settle
+    connections = args.webclients + args.doorclients
+    rss_per = (server.rss_bytes() - rss_before) / connections
+    print(
+        f"{args.webclients} webclients, {args.doorclients} doorclients: "
+        f"{rss_per / 1024:.1f}KiB server RSS per connection"
+    )
+
+    firsts, finals = [], []
+
+    async def unlocker(websocket):
+        for _ in range(args.unlocks):
+            doornum = random.randrange(args.doorclients)
+            first, final = await unlock_roundtrip(websocket, doornum)
+            firsts.append(first)
+            finals.append(final)
+            if args.interval:
+                await asyncio.sleep(random.uniform(0, 2 * args.interval))
+
+    server.loop_lag()  # forget samples taken while connecting
+    start = time.perf_counter()
+    await asyncio.gather(*(unlocker(ws) for ws in webclients))
+    elapsed = time.perf_counter() - start
+    lags = server.loop_lag()
+
+    # each unlock is 6 frames through the doorserver: the unlock in and
+    # out, then an ack and a final ack each in and out
+    print(
+        f"{len(finals)} unlocks in {elapsed:.2f}s: "
+        f"{len(finals) / elapsed:.0f} unlocks/s, "
+        f"{6 * len(finals) / elapsed:.0f} messages/s"
+    )
+    print(f"unlock->first ack: {format_ms(percentiles(firsts))}")
+    print(f"unlock->final ack: {format_ms(percentiles(finals))}")
+    if lags:
+        print(f"event loop lag:    {format_ms(percentiles(lags))}")
+
+    for task in doorclients:
+        task.cancel()
+    for ws in webclients:
+        await ws.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="doorserver-bench",
+        description="Benchmarks for the doorserver websocket protocol",
+    )
+    parser.add_argument(
+        "--rev",
+        help="run the doorserver as of this git revision of the checkout "
+        "instead, e.g. the commit before a change, to compare with",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser(
+        "latency", help="idle CPU cost and unlock->ack latency"
+    )
+    cmd.add_argument("--idle-clients", type=int, default=200)
+    cmd.add_argument("--idle-seconds", type=float, default=10)
+    cmd.add_argument("--unlocks", type=int, default=50)
+    cmd.set_defaults(func=latency)
+
+    cmd = commands.add_parser(
+        "fanout", help="cost of delivering a broadcast to many webclients"
+    )
+    cmd.add_argument(
+        "--webclients", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    cmd.add_argument("--broadcasts", type=int, default=100)
+    cmd.set_defaults(func=fanout)
+
+    cmd = commands.add_parser(
+        "load",
+        help="many webclients unlocking through many fake doorclients",
+    )
+    cmd.add_argument("--webclients", type=int, default=100)
+    cmd.add_argument("--doorclients", type=int, default=4)
+    cmd.add_argument(
+        "--unlocks", type=int, default=20, help="unlocks per webclient"
+    )
+    cmd.add_argument(
+        "--interval",
+        type=float,
+        default=0,
+        help="mean seconds between a webclient's unlocks",
+    )
+    cmd.add_argument(
+        "--relock-delay",
+        type=float,
+        default=0,
+        help="seconds a fake doorclient waits before relocking",
+    )
+    cmd.set_defaults(
+        func=load,
+        server=lambda args: BenchServer(
+            args.doorclients, lag_probe=True, rev=args.rev
+        ),
+    )
+
+    cmd = commands.add_parser(
+        "doorclient",
+        help="unlock->GPIO->relock ack latency through a real doorclient",
+    )
+    cmd.add_argument("--unlocks", type=int, default=50)
+    cmd.add_argument(
+        "--unlocked-duration",
+        type=float,
+        default=0.1,
+        help="seconds the door stays unlocked",
+    )
+    cmd.set_defaults(func=doorclient_latency)
+
+    cmd = commands.add_parser(
+        "codecs", help="wire codec speed and size for real message shapes"
+    )
+    cmd.add_argument("--number", type=int, default=100000)
+    cmd.set_defaults(func=codecbench, server=None)
+
+    parser.set_defaults(server=lambda args: BenchServer(rev=args.rev))
+    args = parser.parse_args()
+    if args.server is None:
+        asyncio.run(args.func(None, args))
+        return
+    with args.server(args) as server:
+        asyncio.run(args.func(server, args))
+
+
+if __name__ == "__main__":
+    main()
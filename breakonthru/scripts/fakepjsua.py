@@ -0,0 +1,146 @@
+"""A stand-in for pjsua, for exercising the doorclient without asterisk or a
+sound card.
+
+It prints the lines the doorclient looks for in pjsua's output, in pjsua's
+format: a registration result at startup, the ``Make call:`` prompt for the
+``m`` command, and call state changes for the calls it pretends to make and
+receive.  Options script how it behaves (slow or failed registration,
+losing its registration or exiting after a while); ``SIGUSR1`` makes it
+receive a call, which it answers, as pjsua does with ``--auto-answer``.  Use
+it as ``pjsua_bin`` in client.ini, e.g. ``pjsua_bin = fake-pjsua --exit-after
+30``."""
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+lock = threading.Lock()
+
+
+def say(line):
+    with lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+class FakePjsua:
+    def __init__(self, args):
+        self.args = args
+        self.calls = 0
+        self.current = None  # the call id of the call in progress
+
+    def later(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        timer.start()
+
+    def state(self, callid, *states):
+        for state in states:
+            if callid != self.current:
+                return  # hung up meanwhile
+            if state == "DISCONNECTED":
+                self.current = None
+                reason = "200 (Normal call clearing)"
+                say(f"Call {callid} is DISCONNECTED [reason={reason}]")
+            else:
+                say(f"Call {callid} state changed to {state}")
+
+    def call(self, incoming):
+        callid = self.current = self.calls
+        self.calls += 1
+        args = self.args
+        if incoming:
+            say("Incoming call for account 0!")
+            self.later(0, self.state, callid, "CONNECTING", "CONFIRMED")
+        else:
+            say(f"Call {callid} state changed to CALLING")
+            self.later(0.01, self.state, callid, "EARLY")
+            answered = ("CONNECTING", "CONFIRMED")
+            self.later(args.answer_after, self.state, callid, *answered)
+        if args.hangup_after is not None:
+            self.later(args.hangup_after, self.state, callid, "DISCONNECTED")
+
+    def register(self, fail=False):
+        uri = f"sip:fake@127.0.0.1:{self.args.local_port}"
+        if fail or self.args.fail_registration:
+            say(f"{uri}: registration failed, status=408 (Request Timeout)")
+        else:
+            say(
+                f"{uri}: registration success, status=200 (OK), "
+                "will re-register in 300 seconds"
+            )
+
+    def run(self):
+        args = self.args
+        signal.signal(signal.SIGUSR1, lambda *arg: self.call(incoming=True))
+        if args.exit_after is not None:
+            # as if it had crashed
+            self.later(args.exit_after, os._exit, 1)
+        if args.lose_registration_after is not None:
+            # a re-registration that fails, while pjsua keeps running
+            self.later(args.lose_registration_after, self.register, True)
+        time.sleep(args.register_delay)
+        self.register()
+        for line in sys.stdin:
+            line = line.strip()
+            if line == "m":
+                with lock:
+                    sys.stdout.write("Make call: ")
+                    sys.stdout.flush()
+                uri = sys.stdin.readline().strip()
+                if uri:
+                    self.call(incoming=False)
+            elif line == "h" and self.current is not None:
+                self.state(self.current, "DISCONNECTED")
+            elif line == "q":
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fake-pjsua",
+        description="Pretend to be pjsua, for testing the doorclient",
+    )
+    parser.add_argument("--config-file", help="ignored")
+    parser.add_argument("--local-port", type=int, default=5060)
+    parser.add_argument(
+        "--register-delay",
+        type=float,
+        default=0.05,
+        help="seconds before reporting the registration result",
+    )
+    parser.add_argument(
+        "--fail-registration",
+        action="store_true",
+        help="report that registration failed",
+    )
+    parser.add_argument(
+        "--answer-after",
+        type=float,
+        default=0.5,
+        help="seconds before a call we make is answered",
+    )
+    parser.add_argument(
+        "--hangup-after",
+        type=float,
+        default=2,
+        help="seconds before a call hangs up by itself",
+    )
+    parser.add_argument(
+        "--lose-registration-after",
+        type=float,
+        help="report a failed re-registration after this many seconds",
+    )
+    parser.add_argument(
+        "--exit-after",
+        type=float,
+        help="exit (status 1) after this many seconds",
+    )
+    args = parser.parse_args()
+    try:
+        FakePjsua(args).run()
+    except KeyboardInterrupt:
+        pass
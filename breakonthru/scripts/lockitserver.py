@@ -0,0 +1,82 @@
+"""Run the webapp and the doorserver in one process.
+
+The doorserver runs on the main thread's event loop as usual, and the
+webapp is served by waitress from its own threads.  The webapp shares the
+doorserver's passwords and token verifier rather than reading the passwords
+file again, and ``directunlock`` hands unlocks to the doorserver with a
+function call instead of over a websocket.  HTTP and websockets are still
+served on two ports (``[server:main]`` and ``[doorserver]``), proxied as
+before."""
+
+import argparse
+import logging
+import os
+import threading
+
+import plaster
+import waitress
+from pyramid.paster import get_appsettings, setup_logging
+
+from breakonthru import main as make_app
+from breakonthru.authentication import token_grace_secs
+from breakonthru.scripts.doorserver import Doorserver
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the webapp and the doorserver in one process"
+    )
+    parser.add_argument(
+        "config_file",
+        help="The webapp's config file (production.ini), optionally with a "
+        "[doorserver] section setting the websocket port",
+    )
+    args = parser.parse_args()
+    config_uri = args.config_file
+    setup_logging(config_uri)
+    logger = logging.getLogger("breakonthru.doorserver")
+    loader = plaster.get_loader(config_uri, protocols=["wsgi"])
+    settings = get_appsettings(config_uri)
+    section = loader.get_settings("doorserver")
+
+    port = os.environ.get("DOORSERVER_WSSERVER_PORT")
+    if port is None:
+        port = section.get("port", 8001)
+    password_file = os.environ.get("DOORSERVER_PASSWORDS_FILE")
+    if password_file is None:
+        password_file = settings["password_file"]
+    doors_file = os.environ.get("DOORSERVER_DOORS_FILE")
+    if doors_file is None:
+        doors_file = settings["doors_file"]
+    secret = os.environ.get("DOORSERVER_WSSECRET")
+    if secret is None:
+        secret = settings["secret"]
+    grace = os.environ.get("DOORSERVER_TOKEN_GRACE_SECS")
+    if grace is None:
+        grace = settings.get("token_grace_secs", token_grace_secs)
+
+    logger.info("MAIN pid is %s", os.getpid())
+    doorserver = Doorserver(
+        secret,
+        password_file,
+        doors_file,
+        int(port),
+        logger,
+        token_grace_secs=int(grace),
+    )
+    # made before any threads are started (the app forks its password
+    # checking processes)
+    app = make_app(settings.global_conf, doorserver=doorserver, **settings)
+    server_settings = dict(loader.get_settings("server:main"))
+    server_settings.pop("use", None)
+    server = waitress.create_server(app, **server_settings)
+    server.print_listen("webapp serving on http://{}:{}")
+    thread = threading.Thread(target=server.run, name="waitress", daemon=True)
+    thread.start()
+    logger.info("doorserver serving on port %s", port)
+    try:
+        doorserver.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
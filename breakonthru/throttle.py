@@ -0,0 +1,124 @@
+"""Admission control for password checks.
+
+A bcrypt check takes tens of milliseconds of CPU on purpose.  Run on
+waitress' threads, a burst of logins (or someone guessing passwords) would
+occupy every thread and stall page and token requests behind it.  Instead,
+checks run in a small process pool, only a limited number may be in flight
+or waiting at once (the rest are turned away immediately), and failed checks
+are rate limited per client address and per username with token buckets."""
+
+import bcrypt
+import concurrent.futures
+import concurrent.futures.process
+import threading
+import time
+
+
+class Overloaded(Exception):
+    """Too many password checks are already in flight"""
+
+
+class Throttled(Exception):
+    """Too many failed password checks from this address or for this user"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """One token bucket per key, holding up to ``burst`` tokens and refilled
+    at ``per_minute`` tokens a minute.  Buckets that have refilled completely
+    are forgotten once there are more than ``maxkeys`` of them."""
+
+    def __init__(self, burst, per_minute, maxkeys=10000):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.maxkeys = maxkeys
+        self.buckets = {}  # key -> (tokens, time.monotonic() of last update)
+        self.lock = threading.Lock()
+
+    def level(self, key, now):
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def wait_time(self, key):
+        """Seconds until ``key`` has a token (0 if it has one now)"""
+        with self.lock:
+            tokens = self.level(key, time.monotonic())
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate
+
+    def take(self, key):
+        with self.lock:
+            now = time.monotonic()
+            self.buckets[key] = (max(self.level(key, now) - 1, 0), now)
+            if len(self.buckets) > self.maxkeys:
+                self.prune(now)
+
+    def prune(self, now):
+        for key in list(self.buckets):
+            if self.level(key, now) >= self.burst:
+                del self.buckets[key]
+
+
+class PasswordChecker:
+    """Checks passwords against bcrypt hashes in a pool of ``workers``
+    processes, allowing at most ``queue_limit`` more checks to wait for a
+    free worker"""
+
+    def __init__(
+        self,
+        workers=1,
+        queue_limit=2,
+        failures_per_ip=10,
+        failures_per_user=5,
+    ):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        self.by_ip = TokenBuckets(failures_per_ip, failures_per_ip)
+        self.by_user = TokenBuckets(failures_per_user, failures_per_user)
+        self.lock = threading.Lock()
+        self.executor = self.start()
+
+    def start(self):
+        # the workers are forked right away, while the app is being created
+        # and waitress hasn't started any threads yet
+        executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        executor.submit(int).result()
+        return executor
+
+    def check(self, ip, username, password, storedhash):
+        """Return True if ``password`` matches ``storedhash`` (a user that
+        doesn't exist has a ``storedhash`` of None).  Raises Throttled if
+        ``ip`` or ``username`` has failed too often lately, and Overloaded if
+        too many checks are already in flight."""
+        retry_after = max(
+            self.by_ip.wait_time(ip), self.by_user.wait_time(username)
+        )
+        if retry_after:
+            raise Throttled(retry_after)
+        matched = False
+        if storedhash is not None:
+            if not self.slots.acquire(blocking=False):
+                raise Overloaded()
+            executor = self.executor
+            try:
+                future = executor.submit(
+                    bcrypt.checkpw,
+                    password.encode("utf-8"),
+                    storedhash.encode("utf-8"),
+                )
+                matched = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died (OOM killer?); replace the pool
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = self.start()
+                raise Overloaded()
+            finally:
+                self.slots.release()
+        if not matched:
+            self.by_ip.take(ip)
+            self.by_user.take(username)
+        return matched
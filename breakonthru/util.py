@@ -1,24 +1,79 @@
+import atexit
 import logging
+import logging.handlers
+import pickle
+import socket
 
+logformat = "%(asctime)s %(message)s"
+logdatefmt = "%m/%d/%Y %I:%M:%S %p"
+log_max_bytes = 10 * 1024 * 1024
+log_backups = 5
 
-def teelogger(logfile=None, loglevel="INFO"):
-    """Log to stdout and logfile"""
-    loglevel = loglevel.upper()
-    logging.basicConfig(
-        filename=logfile,
-        level=getattr(logging, loglevel),
-        format="%(asctime)s %(message)s",
-        datefmt="%m/%d/%Y %I:%M:%S %p",
-    )
-    logger = logging.getLogger()
-    if logfile is not None:
-        # tee to stdout too
-        ch = logging.StreamHandler()
-        ch.setLevel(getattr(logging, loglevel))
-        formatter = logging.Formatter(
-            "%(asctime)s %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p"
+
+class RecordSocket:
+    """The queue between the QueueHandler that every process logs through
+    and the QueueListener that writes: each record is pickled and sent as
+    one datagram on a socket the processes share, which the kernel
+    delivers whole.  Unlike a ``multiprocessing.Queue`` there is no lock
+    shared by the writers and no feeder thread, so a process killed while
+    logging can't leave the others stuck."""
+
+    max_size = 256 * 1024
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
         )
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        # room for a burst, so loggers don't wait on the writer for it
+        self.writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+
+    def put_nowait(self, record):
+        self.writer.send(pickle.dumps(record))
 
+    def get(self, block=True):
+        return pickle.loads(self.reader.recv(self.max_size))
+
+
+def teelogger(
+    logfile=None,
+    loglevel="INFO",
+    max_bytes=log_max_bytes,
+    backups=log_backups,
+    when=None,
+):
+    """Log to stderr and logfile.
+
+    Log calls only send the record over a socket; a listener thread in this
+    process does the writing.  The processes forked after this is called
+    (doorserver workers, doorclient subprocesses) log through the same
+    socket and listener, and their lines are written whole and in the order
+    they arrive.  The logfile is rotated when
+    it reaches ``max_bytes`` (0 to never rotate it), keeping ``backups`` old
+    ones, or, if ``when`` is given, at that interval (a
+    ``TimedRotatingFileHandler`` ``when``, e.g. ``midnight``)."""
+    level = getattr(logging, loglevel.upper())
+    formatter = logging.Formatter(logformat, datefmt=logdatefmt)
+    handlers = [logging.StreamHandler()]
+    if logfile is not None:
+        if when:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                logfile, when=when, backupCount=backups
+            )
+        else:
+            handler = logging.handlers.RotatingFileHandler(
+                logfile, maxBytes=max_bytes, backupCount=backups
+            )
+        handlers.append(handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = RecordSocket()
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    # write out whatever is still queued when the main process exits
+    atexit.register(listener.stop)
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
     return logger
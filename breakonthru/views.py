@@ -1,10 +1,18 @@
-import bcrypt
+import hashlib
 import json
-import requests
+import math
+import os
+import time
 
-from websocket import create_connection
+from websocket import WebSocketException
 
-from pyramid.httpexceptions import HTTPSeeOther
+from pyramid.httpexceptions import (
+    HTTPForbidden,
+    HTTPSeeOther,
+    HTTPServiceUnavailable,
+    HTTPTooManyRequests,
+)
+from pyramid.renderers import render
 from pyramid.security import remember, forget
 from pyramid.view import (
     view_config,
@@ -12,7 +20,9 @@ from pyramid.view import (
     notfound_view_config,
 )
 
+from breakonthru import assets
 from breakonthru.authentication import refresh_token
+from breakonthru.throttle import Overloaded, Throttled
 
 
 @forbidden_view_config(renderer="breakonthru:templates/403.pt")
@@ -34,15 +44,27 @@ def login_view(request):
     password = request.params.get("password")
     if username is not None:
         username = username.lower()
-    userdata = request.registry.settings["passwords"].get(username)
-    if userdata is not None:
-        storedhashbytes = userdata["password"].encode("utf-8")
-        passbytes = password.encode("utf-8")
-        if bcrypt.checkpw(passbytes, storedhashbytes):
-            headers = remember(request, username)
+        try:
+            if check_password(request, username, password):
+                headers = remember(request, username)
+        except Throttled as e:
+            return HTTPTooManyRequests(
+                headers={"Retry-After": str(math.ceil(e.retry_after))}
+            )
+        except Overloaded:
+            return HTTPServiceUnavailable(headers={"Retry-After": "1"})
     return HTTPSeeOther(location="/", headers=headers)
 
 
+def check_password(request, username, password):
+    userdata = request.registry.settings["passwords"].get(username)
+    storedhash = None if userdata is None else userdata["password"]
+    checker = request.registry.settings["password_checker"]
+    return checker.check(
+        request.remote_addr, username, password or "", storedhash
+    )
+
+
 @view_config(
     route_name="logout",
 )
@@ -54,24 +76,35 @@ def logout_view(request):
 
 @view_config(
     route_name="home",
-    renderer="breakonthru:templates/index.pt",
     permission="view",
 )
 def index_view(request):
     username = request.authenticated_userid
-    userdata = request.registry.settings["passwords"].get(username)
-    allowed_doors = userdata["doors"]
-    all_doors = request.registry.settings["doors"]
-    doors = []
-    for n, door in enumerate(all_doors):
-        if n in allowed_doors:
-            doors.append(door)
-    return {
-        "websocket_url": request.registry.settings["websocket_url"],
-        "doorsip": request.registry.settings["doorsip"],
-        "allowed_doors": allowed_doors,
-        "doors": doors,
-    }
+    pages = request.registry.settings["index_pages"]
+    # the page comes with a token so the browser can identify as soon as its
+    # websocket opens
+    token = refresh_token(request, username)
+    if token is None:
+        # logged in, but since removed from the passwords file
+        return logout_view(request)
+    expires = request.registry.settings["token_verifier"].expires(token)
+
+    def render_page(model):
+        return render("breakonthru:templates/index.pt", model, request)
+
+    body, etag = pages.page(
+        username, request.host_url, render_page, token, expires
+    )
+    response = request.response
+    response.body = body
+    response.content_type = "text/html"
+    response.etag = etag
+    # the page is per-user, and must be revalidated so a logged-out
+    # browser doesn't show it
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.conditional_response = True
+    return response
 
 
 @view_config(
@@ -82,49 +115,149 @@ def index_view(request):
 def token_view(request):
     user = request.authenticated_userid
     token = refresh_token(request, user)
-    return {"token": token, "user": user}
+    if token is None:
+        # removed from the passwords file; the page goes to "/" on a 403
+        return HTTPForbidden()
+    verifier = request.registry.settings["token_verifier"]
+    return {
+        "token": token,
+        "user": user,
+        "expires": verifier.expires(token),
+        "now": time.time(),  # lets the browser allow for its clock being off
+    }
+
+
+# what the service worker caches up front, besides the page itself
+shell_assets = (
+    "breakonthru:static/theme.css",
+    "breakonthru:static/door.png",
+    "breakonthru:static/pyramid-16x16.png",
+    "breakonthru:js/index.js",
+)
+cdn_assets = (
+    "https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css",
+    "https://code.jquery.com/jquery-1.12.4.min.js",
+    "https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js",
+)
+
+
+@view_config(route_name="serviceworker")
+def serviceworker_view(request):
+    precache = [request.static_url(spec) for spec in shell_assets]
+    precache.extend(cdn_assets)
+    with open(os.path.join(assets.here, "js", "sw.js")) as f:
+        code = f.read()
+    version = hashlib.sha256((json.dumps(precache) + code).encode("utf-8"))
+    version = version.hexdigest()
+    response = request.response
+    response.content_type = "application/javascript"
+    response.cache_control.no_cache = True  # browsers check for updates
+    response.text = (
+        f"var VERSION = {json.dumps(version[:16])}\n"
+        f"var PRECACHE = {json.dumps(precache)}\n\n{code}"
+    )
+    return response
+
+
+@view_config(route_name="manifest", renderer="json")
+def manifest_view(request):
+    request.response.content_type = "application/manifest+json"
+    return {
+        "name": "Door",
+        "short_name": "Door",
+        "start_url": "/",
+        "scope": "/",
+        "display": "standalone",
+        "background_color": "#ffffff",
+        "theme_color": "#ffffff",
+        "icons": [
+            {
+                "src": request.static_url("breakonthru:static/door.png"),
+                "sizes": "217x283",
+                "type": "image/png",
+            },
+        ],
+    }
 
 
 @view_config(route_name="directunlock")
 def directunlock_view(request):
-    reqdata = {}
-    reqdata["username"] = request.params["username"]
-    reqdata["password"] = request.params["password"]
-    doornum = int(request.params["doornum"])
-    all_doors = request.registry.settings["doors"]
-    opened = None
-    for n, door in enumerate(all_doors):
-        if n == doornum:
-            opened = door
-            break
-    else:  # nobreak
+    """Unlock one or more doors (``doornum`` may be given several times).
+
+    With a single door and no ``wait``, answers in plain text as soon as the
+    unlock has been sent.  Otherwise answers in JSON with the state of each
+    door and the milliseconds until the doorclient acked it and relocked it,
+    having waited up to ``timeout`` seconds for every door to be acked
+    (``wait=ack``) or relocked (``wait=relock``)."""
+    username = request.params["username"].lower()
+    password = request.params["password"]
+    doornums = [int(x) for x in request.params.getall("doornum")]
+    wait = request.params.get("wait")
+    timeout = min(float(request.params.get("timeout", 10)), 60)
+    plain = len(doornums) == 1 and wait is None
+
+    def reply(status, text):
         response = request.response
-        response.text = "No such door %s" % doornum
-        response.content_type = "text/plain"
+        response.status = status
+        if plain:
+            response.content_type = "text/plain"
+            response.text = text
+        else:
+            response.content_type = "application/json"
+            response.json_body = {"error": text}
         return response
-    login_url = request.host_url + "/login"
-    token_url = request.host_url + "/token"
-    session = requests.Session()
-    with session:
-        session.post(login_url, data=reqdata)
-        r = session.get(token_url)
-        tokendata = json.loads(r.content)
-    identificationdata = {
-        "type": "identification",
-        "body": "webclient",
-        "user": tokendata["user"],
-        "token": tokendata["token"],
-    }
-    unlockdata = {
-        "type": "unlock",
-        "body": tokendata["user"],
-        "doornum": doornum,
-    }
-    websocket_url = request.registry.settings["websocket_url"]
-    ws = create_connection(websocket_url)
-    ws.send(json.dumps(identificationdata))
-    ws.send(json.dumps(unlockdata))
+
+    if not doornums:
+        return reply(400, "No doornum")
+    if wait not in (None, "ack", "relock"):
+        return reply(400, "wait must be ack or relock")
+    all_doors = request.registry.settings["doors"]
+    for doornum in doornums:
+        if not 0 <= doornum < len(all_doors):
+            return reply(400, "No such door %s" % doornum)
+    try:
+        if not check_password(request, username, password):
+            return reply(403, "Bad username or password")
+    except Throttled as e:
+        request.response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+        return reply(429, "Too many failed attempts")
+    except Overloaded:
+        request.response.headers["Retry-After"] = "1"
+        return reply(503, "Too busy")
+    userdata = request.registry.settings["passwords"][username]
+    for doornum in doornums:
+        if doornum not in userdata["doors"]:
+            return reply(403, "Not allowed to open %s" % all_doors[doornum])
+    client = request.registry.settings["doorserver_client"]
+    try:
+        statuses = client.unlock(username, doornums)
+    except (OSError, WebSocketException):
+        return reply(503, "Could not reach the doorserver")
+    if plain:
+        client.forget(statuses)
+        return reply(200, "OK, opened %s" % all_doors[doornums[0]])
+    timed_out = False
+    if wait is not None:
+        deadline = time.monotonic() + timeout
+        for status in statuses:
+            if not status.wait(wait, deadline):
+                timed_out = True
+                break
+    client.forget(statuses)
+    doors = []
+    for status in statuses:
+        door = {
+            "doornum": status.doornum,
+            "door": all_doors[status.doornum],
+            "state": status.state,
+        }
+        door.update(status.timings())
+        doors.append(door)
     response = request.response
-    response.text = "OK, opened %s" % opened
-    response.content_type = "text/plain"
+    response.content_type = "application/json"
+    response.json_body = {
+        "user": username,
+        "timed_out": timed_out,
+        "doors": doors,
+    }
     return response
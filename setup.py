@@ -15,11 +15,10 @@ requires = [
     # "pyramid_debugtoolbar", # not packaged via nix
     "waitress",
     "bcrypt",
-    "websockets",
+    "websockets>=14",
     "gpiozero",
     "pexpect",
     "setproctitle",
-    "requests",
     "websocket-client",
 ]
 
@@ -52,6 +51,9 @@ setup(
     zip_safe=False,
     extras_require={
         "testing": tests_require,
+        "msgpack": ["msgpack"],
+        "cbor": ["cbor2"],
+        "brotli": ["brotli"],
     },
     install_requires=requires,
     entry_points={
@@ -60,7 +62,11 @@ setup(
         ],
         "console_scripts": [
             "doorserver = breakonthru.scripts.doorserver:main",
+            "doorserver-bench = breakonthru.scripts.doorserverbench:main",
+            "build-assets = breakonthru.scripts.buildassets:main",
             "doorclient = breakonthru.scripts.doorclient:main",
+            "fake-pjsua = breakonthru.scripts.fakepjsua:main",
+            "lockit-server = breakonthru.scripts.lockitserver:main",
             "wavplayer = breakonthru.scripts.wavplayer:main",
         ],
     },